@@ -1,9 +1,16 @@
 import gc
+import inspect
+import os
+import sys
+import csv
+import time
+import threading
 
 import numpy as np
+import pandas as pd
 import tensorflow as tf
 import tensorflow.keras.backend as K
-from custom_metrics import cm_image
+from custom_metrics import plot_confusion_matrix, plot_to_image
 
 
 class MemFix(tf.keras.callbacks.Callback):
@@ -16,21 +23,35 @@ class MemFix(tf.keras.callbacks.Callback):
 
 
 class EnrTensorboard(tf.keras.callbacks.TensorBoard):
-    def __init__(self, val_data, class_names, **kwargs):
+    """
+    TensorBoard with the learning rate and the validation confusion matrices. The matrices are read from the
+    `total_cm` of the GeometricMean metrics, which at the end of an epoch hold the validation pass, so no extra
+    predictions are made. `class_names` is a list, or a dict of lists keyed by output name for multi-output models.
+    """
+    def __init__(self, class_names, **kwargs):
         super().__init__(**kwargs)
         self.class_names = class_names
-        self.val_data = val_data
 
     def on_epoch_end(self, epoch, logs=None):
         logs = logs or {}
-        logs["learning_rate"] = self.model.optimizer.lr
-        with super()._val_writer.as_default():
-            tf.summary.image("Confusion Matrix",
-                             tf.expand_dims(
-                                 tf.image.decode_png(cm_image(
-                                     y_true=np.argmax(np.concatenate(list(self.val_data.map(lambda samples, labels: labels['class']))), axis=-1),
-                                     y_pred=np.argmax(self.model.predict(self.val_data), axis=-1), class_names=self.class_names), channels=3), 0),
-                             step=epoch)
+        learning_rate = self.model.optimizer.learning_rate
+        if isinstance(learning_rate, tf.keras.optimizers.schedules.LearningRateSchedule):
+            learning_rate = learning_rate(self.model.optimizer.iterations)
+        logs['learning_rate'] = float(K.get_value(learning_rate))
+        if any(key.startswith('val_') for key in logs):  # Otherwise the metrics hold the training epoch
+            with self._val_writer.as_default():
+                for metric in self.model.metrics:
+                    if not hasattr(metric, 'total_cm'):
+                        continue
+                    if isinstance(self.class_names, dict):
+                        class_names = next(names for output, names in self.class_names.items()
+                                           if metric.name.startswith(output))
+                    else:
+                        class_names = self.class_names
+                    png = plot_to_image(plot_confusion_matrix(cm=K.get_value(metric.total_cm).astype(int),
+                                                              class_names=class_names))
+                    tf.summary.image(metric.name.replace('geometric_mean', 'confusion_matrix'),
+                                     tf.expand_dims(tf.image.decode_png(png, channels=3), 0), step=epoch)
         super().on_epoch_end(epoch=epoch, logs=logs)
 
 
@@ -56,3 +77,309 @@ class LaterReduceLROnPlateau(tf.keras.callbacks.ReduceLROnPlateau):
             if self.start_at == epoch + 1:
                 print('Epoch {} reached. Start checking lr'.format(self.start_at))
             super().on_epoch_end(epoch=epoch, logs=logs)
+
+
+class StagedEarlyStopping(tf.keras.callbacks.EarlyStopping):
+    """
+    EarlyStopping whose best value and wait counter carry over consecutive `fit` calls, e.g. resizing stages. Keeps
+    the epoch of the best value in `best_epoch` on TF versions without it.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.started = False
+        self.best_epoch = 0
+
+    def on_train_begin(self, logs=None):
+        if not self.started:
+            super().on_train_begin(logs=logs)
+            self.started = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        best = self.best
+        super().on_epoch_end(epoch, logs=logs)
+        if self.best != best:
+            self.best_epoch = epoch
+
+
+class ResumableCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Every `every` epochs checkpoints the weights, the optimizer slots, the number of finished epochs, the augmentation
+    RNG state and the best/wait/best_epoch state of `early_stopping` with a CheckpointManager keeping the last
+    `max_to_keep`. Checkpoints are written asynchronously where the TF version supports it, and the best weights of
+    early stopping (host copies already) in a background thread. Place after `early_stopping` in the callbacks.
+    """
+    def __init__(self, directory, early_stopping, rng=None, every=1, max_to_keep=3, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.early_stopping = early_stopping
+        self.rng = rng
+        self.every = every
+        self.max_to_keep = max_to_keep
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.best = tf.Variable(0., dtype=tf.float64, trainable=False)
+        self.wait = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.best_epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint, self.manager, self.writer = None, None, None
+        self.saved_best_weights = None  # The best weights of early stopping last written to best_weights.npz
+        if 'experimental_enable_async_checkpoint' in inspect.signature(tf.train.CheckpointOptions).parameters:
+            self.options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        else:
+            self.options = tf.train.CheckpointOptions()
+        self.best_weights_path = os.path.join(directory, 'best_weights.npz')
+
+    def set_model(self, model):
+        super().set_model(model)
+        if self.manager is None:
+            trackables = {'model': model, 'optimizer': model.optimizer, 'epoch': self.epoch, 'best': self.best,
+                          'wait': self.wait, 'best_epoch': self.best_epoch}
+            if self.rng is not None:
+                trackables['rng'] = self.rng
+            self.checkpoint = tf.train.Checkpoint(**trackables)
+            self.manager = tf.train.CheckpointManager(self.checkpoint, self.directory, max_to_keep=self.max_to_keep)
+
+    def restore(self, model, directory=None):
+        """
+        Restores the latest checkpoint and returns the number of finished epochs to resume from.
+        directory: folder to restore from instead of `directory`, e.g. the chief's for workers writing in scratch folders.
+        """
+        self.set_model(model)
+        directory = directory or self.directory
+        latest_checkpoint = tf.train.latest_checkpoint(directory)
+        if latest_checkpoint is None:
+            raise FileNotFoundError(f'No checkpoint to resume from in {directory}.')
+        self.checkpoint.restore(latest_checkpoint)  # Optimizer slots are restored on creation
+        self.early_stopping.best = float(self.best.numpy())
+        self.early_stopping.wait = int(self.wait.numpy())
+        self.early_stopping.best_epoch = int(self.best_epoch.numpy())
+        self.early_stopping.started = True  # Keep the restored state on train begin
+        best_weights_path = os.path.join(directory, 'best_weights.npz')
+        if os.path.isfile(best_weights_path):
+            with np.load(best_weights_path) as best_weights:
+                self.early_stopping.best_weights = [best_weights[f'arr_{i}'] for i in range(len(best_weights.files))]
+            self.saved_best_weights = self.early_stopping.best_weights
+        print(f"Resumed from {latest_checkpoint} after epoch {int(self.epoch.numpy())}")
+        return int(self.epoch.numpy())
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every:
+            return
+        self.epoch.assign(epoch + 1)
+        self.best.assign(self.early_stopping.best)
+        self.wait.assign(self.early_stopping.wait)
+        self.best_epoch.assign(self.early_stopping.best_epoch)
+        self.manager.save(checkpoint_number=epoch + 1, options=self.options)
+        # Improved since the last checkpoint, possibly in an epoch without a checkpoint. Early stopping replaces the list
+        if self.early_stopping.best_weights is not None and self.early_stopping.best_weights is not self.saved_best_weights:
+            self._join()
+            self.saved_best_weights = self.early_stopping.best_weights
+            os.makedirs(self.directory, exist_ok=True)  # Not created yet by an asynchronous first save
+            self.writer = threading.Thread(target=np.savez, args=(self.best_weights_path,
+                                                                  *self.early_stopping.best_weights))
+            self.writer.start()
+
+    def on_train_end(self, logs=None):
+        self._join()
+        if hasattr(self.checkpoint, 'sync'):  # Wait for asynchronous writes
+            self.checkpoint.sync()
+
+    def _join(self):
+        if self.writer is not None:
+            self.writer.join()
+
+
+class StepTimeProfiler(tf.keras.callbacks.Callback):
+    """
+    Records per step wall time, time blocked waiting on the input iterator and examples/sec to `step_times.csv`, and
+    adds their epoch means to the logs. The train function is replaced by one that fetches the next batch eagerly, so
+    the wait is measured on its own, then runs `train_step` on it. Optionally traces steps
+    `profile_window[0]` to `profile_window[1]` (global, 0-based) with tf.profiler into `log_dir`.
+    """
+    def __init__(self, save_dir, global_batch_size, profile_window=None, log_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        self.save_path = os.path.join(save_dir, 'step_times.csv')
+        self.global_batch_size = global_batch_size
+        self.profile_window = profile_window
+        self.log_dir = log_dir
+        self.global_step = 0
+        self.epoch = 0
+        self.records = []
+        self.data_wait = 0.
+        self.step_start = None
+        self.tracing = False
+
+    def on_train_begin(self, logs=None):
+        model = self.model
+        strategy = model.distribute_strategy
+
+        @tf.function
+        def step_function(data):
+            outputs = strategy.run(model.train_step, args=(data,))
+            model._train_counter.assign_add(1)
+            return tf.nest.map_structure(lambda value: strategy.experimental_local_results(value)[0], outputs)
+
+        def timed_train_function(iterator):
+            start = time.perf_counter()
+            data = next(iterator)
+            self.data_wait = time.perf_counter() - start
+            return step_function(data)
+
+        model.train_function = timed_train_function
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        self.records = []
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_window and self.global_step == self.profile_window[0]:
+            tf.profiler.experimental.start(self.log_dir)
+            self.tracing = True
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        wall_time = time.perf_counter() - self.step_start  # Logs are synced to numpy before this, so the step is done
+        self.records.append({'epoch': self.epoch, 'step': batch, 'global_step': self.global_step,
+                             'wall_time': wall_time, 'data_wait': self.data_wait,
+                             'examples_per_sec': self.global_batch_size / wall_time})
+        if self.tracing and self.global_step >= self.profile_window[1]:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        self.global_step += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.records:
+            return
+        write_header = not os.path.isfile(self.save_path)
+        with open(self.save_path, 'a') as f:
+            writer = csv.DictWriter(f, fieldnames=list(self.records[0]))
+            if write_header:
+                writer.writeheader()
+            writer.writerows(self.records)
+        if logs is not None:
+            wall_time = np.sum([record['wall_time'] for record in self.records])
+            logs['step_time'] = wall_time / len(self.records)
+            logs['data_wait_frac'] = np.sum([record['data_wait'] for record in self.records]) / wall_time
+            logs['examples_per_sec'] = self.global_batch_size * len(self.records) / wall_time
+
+    def on_train_end(self, logs=None):
+        if self.tracing:  # Training ended inside the trace window
+            tf.profiler.experimental.stop()
+            self.tracing = False
+
+
+class HardExampleMining(tf.keras.callbacks.Callback):
+    """
+    Draws the training samples of every epoch with probabilities proportional to their latest loss, recorded by
+    SampleLossTracker, so that easy samples are read and augmented less often. Every sample keeps at least `floor`
+    times the uniform probability, and samples without a loss yet get the highest loss seen. The probabilities are
+    rebuilt every `every` epochs.
+    """
+    def __init__(self, floor=.1, every=1, **kwargs):
+        super().__init__(**kwargs)
+        self.floor = floor
+        self.every = every
+        self.image_path, self.probabilities, self.size = None, None, 0
+
+    def reset(self, image_path, size):
+        """Uniform sampling of `size` samples per epoch out of `image_path`, the train set of get_train_dataset."""
+        self.image_path, self.size = image_path, size
+        self.probabilities = np.full(len(image_path), 1. / len(image_path))
+
+    def indices(self):
+        """Sample indices of one epoch, drawn when the epoch's iterator starts."""
+        yield from np.random.choice(len(self.image_path), size=self.size, p=self.probabilities)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if (epoch + 1) % self.every or self.image_path is None:
+            return
+        keys, values = self.model.sample_loss.export()
+        sample_loss = pd.Series(values.numpy(), index=keys.numpy().astype(str))
+        sample_loss = sample_loss.reindex(self.image_path.astype(str)).values
+        seen = ~np.isnan(sample_loss)
+        if not np.any(seen):
+            return
+        sample_loss = np.where(seen, sample_loss, np.max(sample_loss[seen]))
+        probabilities = np.maximum(sample_loss, 0.) / max(np.sum(np.maximum(sample_loss, 0.)), 1e-12)
+        self.probabilities = self.floor / len(sample_loss) + (1. - self.floor) * probabilities
+        self.probabilities /= np.sum(self.probabilities)
+        if logs is not None:  # Share of the probability held by the hardest 10% of the samples
+            logs['hard_top10_frac'] = np.sum(np.sort(self.probabilities)[-max(len(sample_loss) // 10, 1):])
+
+
+class FullValidation(tf.keras.callbacks.Callback):
+    """
+    Evaluates `validation_data`, the full validation set, every `every` epochs and at `last_epoch`, while fit validates
+    on a subset. Results are logged as full_val_* on every epoch, NaN in between, so that the val_* signal of early
+    stopping comes from the same subset throughout. The confusion matrices of the subset are kept for EnrTensorboard.
+    Place before TensorBoard and CSVLogger.
+    """
+    def __init__(self, validation_data, every=10, last_epoch=None, save_dir=None, **kwargs):
+        super().__init__(**kwargs)
+        self.validation_data = validation_data
+        self.every = every
+        self.last_epoch = last_epoch
+        self.save_dir = save_dir
+
+    def on_epoch_end(self, epoch, logs=None):
+        results = {}
+        if (epoch + 1) % self.every == 0 or epoch + 1 == self.last_epoch:
+            confusion_matrices = [(metric, K.get_value(metric.total_cm)) for metric in self.model.metrics
+                                  if hasattr(metric, 'total_cm')]
+            results = self.model.evaluate(self.validation_data, verbose=0, return_dict=True)
+            for metric, confusion_matrix in confusion_matrices:  # evaluate refilled them with the full set
+                metric.total_cm.assign(confusion_matrix)
+        for key in [key for key in (logs or {}) if key.startswith('val_')]:
+            logs[f'full_{key}'] = results.get(key[len('val_'):], np.nan)
+
+    def evaluate_final(self, epoch):
+        """
+        Full validation of the model as training left it, i.e. with the best weights once early stopping restored them,
+        written to `full_validation.csv` in `save_dir`. `epoch` is the epoch of the weights. Call after fit.
+        """
+        results = {f'full_val_{key}': value for key, value in
+                   self.model.evaluate(self.validation_data, verbose=0, return_dict=True).items()}
+        print(f'Full validation of the final model, from epoch {epoch}| ' +
+              ' '.join(f'{key}: {value:.4f}' for key, value in results.items()))
+        if self.save_dir is not None:
+            pd.DataFrame([{'epoch': epoch, **results}]).to_csv(os.path.join(self.save_dir, 'full_validation.csv'), index=False)
+
+
+def rss_mb():
+    """Current resident set size of this process in MiB, NaN where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return np.nan
+
+
+class MemoryTracker(tf.keras.callbacks.Callback):
+    """
+    Logs host memory per epoch to `memory.csv`: RSS, Python allocated blocks and tracked objects, and device allocator
+    usage where there is a GPU. tf.data buffers (prefetch, shuffle, batch) and TF tensors live in the native heap, so
+    RSS growing while the Python counters stay flat points at the input pipeline or the runtime, not Python objects.
+    """
+    def __init__(self, save_dir, **kwargs):
+        super().__init__(**kwargs)
+        self.save_path = os.path.join(save_dir, 'memory.csv')
+        self.start_rss = None
+
+    def on_train_begin(self, logs=None):
+        if self.start_rss is None:
+            self.start_rss = rss_mb()
+
+    def on_epoch_end(self, epoch, logs=None):
+        record = {'epoch': epoch, 'rss_mb': rss_mb(), 'python_blocks': sys.getallocatedblocks(),
+                  'gc_objects': len(gc.get_objects())}
+        record['rss_growth_mb'] = record['rss_mb'] - self.start_rss
+        for device in tf.config.list_logical_devices('GPU'):
+            memory_info = tf.config.experimental.get_memory_info(device.name)
+            record[f"{device.name}_current_mb"] = memory_info['current'] / 2 ** 20
+            record[f"{device.name}_peak_mb"] = memory_info['peak'] / 2 ** 20
+        write_header = not os.path.isfile(self.save_path)
+        with open(self.save_path, 'a') as f:
+            writer = csv.DictWriter(f, fieldnames=list(record))
+            if write_header:
+                writer.writeheader()
+            writer.writerow(record)
+        if logs is not None:
+            logs['rss_mb'] = record['rss_mb']
@@ -60,8 +60,9 @@ def categorical_focal_loss(alpha=[1., 1.], gamma=2.):
         :param y_pred: A tensor resulting from a softmax
         :return: Output tensor.
         """
-        # Clip the prediction value to prevent NaN's and Inf's
+        # Clip the prediction value to prevent NaN's and Inf's. In float32, as 1 - 1e-7 rounds to 1 in float16.
         epsilon = 1e-7
+        y_true, y_pred = tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)
         y_pred = tf.clip_by_value(y_pred, epsilon, 1. - epsilon)
         # Calculate Cross Entropy
         cross_entropy = - tf.math.multiply(x=y_true, y=tf.math.log(y_pred))
@@ -89,6 +90,7 @@ def combined_loss(frac, gamma=2.):
         """Inputs: y_pred: probs form per class
                    y_true: one-hot encoding of label
         """
+        y_true, y_pred = tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)
         if frac == 0.:
             return cxe(y_true, y_pred)
         elif frac == 1.:
@@ -100,8 +102,23 @@ def combined_loss(frac, gamma=2.):
     return total_loss
 
 
-def losses(args):
+def distillation_loss(temperature=4.):
+    """
+    Soft-target loss for knowledge distillation (Hinton et al. https://arxiv.org/abs/1503.02531).
+    Both teacher and student end in softmax, so their logits are recovered as log-probabilities and softened by the
+    temperature. The KL divergence is scaled by temperature^2 to keep gradient magnitudes comparable to the hard loss.
+    """
+    def distillation_loss_fixed(teacher_pred, student_pred):
+        epsilon = 1e-7
+        teacher_pred, student_pred = tf.cast(teacher_pred, tf.float32), tf.cast(student_pred, tf.float32)
+        teacher_soft = tf.nn.softmax(tf.math.log(tf.clip_by_value(teacher_pred, epsilon, 1.)) / temperature, axis=-1)
+        student_soft = tf.nn.softmax(tf.math.log(tf.clip_by_value(student_pred, epsilon, 1.)) / temperature, axis=-1)
+        return tf.keras.losses.kl_divergence(teacher_soft, student_soft) * temperature ** 2
+    return distillation_loss_fixed
+
+
+def losses(args, num_classes=2):
     return {'cxe': 'categorical_crossentropy',
-            'focal': categorical_focal_loss(alpha=[1., 1.]),
+            'focal': categorical_focal_loss(alpha=[1.] * num_classes),
             'combined': combined_loss(args['loss_frac'])}  # ,
             # 'perclass': CMWeightedCategoricalCrossentropy(args=args)}
@@ -1,19 +1,14 @@
 import os
 import io
 import itertools
-from typeguard import typechecked
 from typing import Optional
 import numpy as np
-import pandas as pd
 import tensorflow as tf
-from matplotlib import pyplot as plt
-from tensorflow_addons.utils.types import FloatTensorLike, AcceptableDTypes
 
 from features_def import TASK_CLASSES
-from sklearn.metrics import confusion_matrix, average_precision_score, roc_auc_score, roc_curve, \
-    precision_recall_curve, classification_report
 
-from settings import parser
+# pandas, sklearn and matplotlib are imported where the reports use them, so that loading a model with the custom
+# objects of this module only costs the TensorFlow import.
 
 
 def gmean(y_true, y_pred):
@@ -59,15 +54,50 @@ def metrics(y_pred, y_true):
 def calc_metrics(model, args, dirs, dataset, dataset_name, dist_thresh=None, f1_thresh=None):
     print(f"Calculate metrics for {dataset_name} {args['image_type']}...")
     save_dir = os.path.join(dirs['trial'], '_'.join([dataset_name, args['image_type']]))
-    os.makedirs(save_dir, exist_ok=True)
-    if dataset_name != 'isic20_test':
-        df_dict = {'image_name': np.concatenate(list(dataset.map(lambda samples, labels: samples['image_path'])))}
-        labels = np.concatenate(list(dataset.map(lambda samples, labels: labels['class'])))
-    else:
-        df_dict = {'image_name': np.concatenate(list(dataset.map(lambda samples: samples['image_path'])))}
+    image_names = np.concatenate(list(dataset.map(lambda samples, *labels: samples['image_path'])))
     output = model.predict(dataset)
-
-    for i, class_name in enumerate(TASK_CLASSES[args['task']]):
+    if not args['multi_task']:
+        labels = None
+        if dataset_name != 'isic20_test':
+            labels = np.concatenate(list(dataset.map(lambda samples, labels: labels['class'])))
+        return task_metrics(args=args, task=args['task'], dirs=dirs, image_names=image_names, output=output,
+                            labels=labels, dataset_name=dataset_name, save_dir=save_dir,
+                            dist_thresh=dist_thresh, f1_thresh=f1_thresh)
+
+    # Multi-task model: every head's report comes from the single forward pass above.
+    outputs = dict(zip(model.output_names, output))
+    dist_thresh, f1_thresh = dist_thresh or {}, f1_thresh or {}
+    for task in TASK_CLASSES:
+        head = f'class_{task}'
+        if dataset_name == 'isic20_test':
+            if task == 'ben_mal':
+                task_metrics(args=args, task=task, dirs=dirs, image_names=image_names, output=outputs[head],
+                             labels=None, dataset_name=dataset_name, save_dir=os.path.join(save_dir, task))
+            continue
+        labels = np.concatenate(list(dataset.map(lambda samples, labels, *sample_weight: labels[head])))
+        applies = np.sum(labels, axis=-1) > 0  # Samples outside the task's classes have an all-zero label
+        if not np.any(applies):
+            continue
+        dist_thresh[task], f1_thresh[task] = task_metrics(args=args, task=task, dirs=dirs,
+                                                          image_names=image_names[applies],
+                                                          output=outputs[head][applies], labels=labels[applies],
+                                                          dataset_name=dataset_name,
+                                                          save_dir=os.path.join(save_dir, task),
+                                                          dist_thresh=dist_thresh.get(task),
+                                                          f1_thresh=f1_thresh.get(task))
+    if dataset_name == 'validation':
+        return dist_thresh, f1_thresh
+    return None, None
+
+
+def task_metrics(args, task, dirs, image_names, output, labels, dataset_name, save_dir, dist_thresh=None, f1_thresh=None):
+    import pandas as pd
+    from matplotlib import pyplot as plt
+    from sklearn.metrics import average_precision_score, roc_auc_score, roc_curve, precision_recall_curve, \
+        classification_report
+    os.makedirs(save_dir, exist_ok=True)
+    df_dict = {'image_name': image_names}
+    for i, class_name in enumerate(TASK_CLASSES[task]):
         df_dict[f"{class_name}"] = np.round(output[:, i], 5)
         if dataset_name != 'isic20_test':
             df_dict[f"{class_name + '_true'}"] = labels[:, i]
@@ -86,7 +116,7 @@ def calc_metrics(model, args, dirs, dataset, dataset_name, dist_thresh=None, f1_
         # because it corresponds to accuracy otherwise and would be the same for all metrics.
         # One-vs-one. Computes the average AUC of all possible pairwise combinations of classes.
         # Insensitive to class imbalance when `average == 'macro'`.
-        if args['task'] != '5cls':
+        if task != '5cls':
             fpr_lst, tpr_lst, roc_thresh = roc_curve(y_true=np.argmax(labels, axis=-1),
                                                      y_score=output[:, 1], pos_label=1)
             prec_lst, rec_lst, pr_thresh = precision_recall_curve(y_true=np.argmax(labels, axis=-1),
@@ -101,39 +131,39 @@ def calc_metrics(model, args, dirs, dataset, dataset_name, dist_thresh=None, f1_
                 f1_thresh = pr_thresh[np.argmax(f1_values)]  # Threshold with maximum F1 score
             for threshold in (0.5,):  # dist_thresh, f1_thresh
                 y_pred_thrs = np.greater_equal(output, threshold).astype(np.int32)
-                cm_img = cm_image(y_true=np.argmax(labels, axis=-1), y_pred=y_pred_thrs[:, 1], class_names=TASK_CLASSES[args['task']])
+                cm_img = cm_image(y_true=np.argmax(labels, axis=-1), y_pred=y_pred_thrs[:, 1], class_names=TASK_CLASSES[task])
                 with open(os.path.join(save_dir, "cm_{}.png".format(str(round(threshold, 2)))), "wb") as f:
                     f.write(cm_img)
 
                 with open(os.path.join(save_dir, "report_{}.txt".format(str(round(threshold, 2)))), "w") as f:
                     f.write(classification_report(y_true=labels, y_pred=y_pred_thrs,
-                                                  target_names=TASK_CLASSES[args['task']], digits=3, zero_division=0))
+                                                  target_names=TASK_CLASSES[task], digits=3, zero_division=0))
                     f.write("{} {} {}\n".format(' '.rjust(12), 'thresh_dist'.rjust(10), 'thresh_f1'.rjust(10)))
                     f.write('{} {} {}\n'.format(' '.rjust(12), str(dist_thresh).rjust(10), str(f1_thresh).rjust(10)))
 
                 with open(os.path.join(save_dir, 'metrics_{}.csv'.format(str(round(threshold, 2)))), 'w') as f:
                     f.write('Class,Balanced Accuracy,Precision,Sensitivity (Recall),Specificity,Accuracy,AUC,F1,F2,'
                             'G-Mean,Average Precision\n')
-                    for _class in range(len(TASK_CLASSES[args['task']])):
+                    for _class in range(len(TASK_CLASSES[task])):
                         AP = np.round(average_precision_score(y_true=labels[:, _class], y_score=output[:, _class]), 3)
                         ROC_AUC = np.round(roc_auc_score(y_true=labels[:, _class], y_score=output[:, _class]), 3)
                         m_dict = metrics(y_pred=y_pred_thrs[:, _class], y_true=labels[:, _class])
                         f.write(
-                            f"{TASK_CLASSES[args['task']][_class]},{m_dict['balanced_accuracy']},{m_dict['precision']},"
+                            f"{TASK_CLASSES[task][_class]},{m_dict['balanced_accuracy']},{m_dict['precision']},"
                             f"{m_dict['sensitivity']},{m_dict['specificity']},{m_dict['accuracy']},"
                             f"{ROC_AUC},{m_dict['F1']},{m_dict['F2']},{m_dict['gmean']},{AP}\n")
 
             plt.figure(1)
             plt.title('ROC curve'), plt.gca().set_aspect('equal', adjustable='box')
             plt.xlabel('False positive rate'), plt.ylabel('True positive rate')
-            plt.plot(fpr_lst, tpr_lst, label=' '.join([TASK_CLASSES[args['task']][1], '(AUC= {:.3f})'.format(ROC_AUC)]))
+            plt.plot(fpr_lst, tpr_lst, label=' '.join([TASK_CLASSES[task][1], '(AUC= {:.3f})'.format(ROC_AUC)]))
             plt.plot([0, 1], [0, 1], 'k--'), plt.legend(loc='best')
             plt.figure(1), plt.savefig(os.path.join(save_dir, 'roc_curve.png'))
 
             plt.figure(2)
             plt.title('PR curve'), plt.gca().set_aspect('equal', adjustable='box')
             plt.xlabel('Recall'), plt.ylabel('Precision')
-            plt.plot(rec_lst, prec_lst, label=' '.join([TASK_CLASSES[args['task']][1], '(AP= {:.3f})'.format(AP)]))
+            plt.plot(rec_lst, prec_lst, label=' '.join([TASK_CLASSES[task][1], '(AP= {:.3f})'.format(AP)]))
             plt.legend(loc='best')
             plt.figure(2), plt.savefig(os.path.join(save_dir, 'pr_curve.png'))
             plt.close('all')
@@ -150,6 +180,7 @@ def plot_confusion_matrix(cm, class_names):
        cm (array, shape = [n, n]): a confusion matrix of integer classes
        class_names (array, shape = [n]): String names of the integer classes
     """
+    from matplotlib import pyplot as plt
 
     figure = plt.figure(figsize=(5, 5))
     normalized_cm = cm / np.expand_dims(cm.sum(axis=1), axis=-1)
@@ -176,6 +207,7 @@ def plot_to_image(figure):
     Converts the matplotlib plot specified by 'figure' to a PNG image and
     returns it. The supplied figure is closed and inaccessible after this call.
     """
+    from matplotlib import pyplot as plt
     # Save the plot to a PNG in memory.
     buf = io.BytesIO()
     plt.savefig(buf, format='png')
@@ -185,6 +217,7 @@ def plot_to_image(figure):
 
 
 def cm_image(y_true, y_pred, class_names: list):
+    from sklearn.metrics import confusion_matrix
     figure = plot_confusion_matrix(cm=confusion_matrix(y_true=y_true, y_pred=y_pred), class_names=class_names)
     return plot_to_image(figure)
 
@@ -233,14 +266,13 @@ class GMean(tf.keras.metrics.Metric):
 
     """
 
-    @typechecked
     def __init__(
             self,
-            num_classes: FloatTensorLike,
+            num_classes: int,
             average: Optional[str] = None,
-            threshold: Optional[FloatTensorLike] = None,
+            threshold: Optional[float] = None,
             name: str = "gmean",
-            dtype: AcceptableDTypes = None,
+            dtype=None,
             **kwargs,
     ):
         super().__init__(name=name, dtype=dtype)
@@ -340,15 +372,19 @@ class GMean(tf.keras.metrics.Metric):
 
 class GeometricMean(tf.keras.metrics.Metric):
     """
-    A custom Keras metric to compute the running average of the confusion matrix
+    A custom Keras metric to compute the running average of the confusion matrix.
+    num_classes is saved with the model. Models saved without it rebuild a binary matrix, so multiclass (5cls) models
+    saved before must be loaded with compile=False, as main.py does, and compiled again.
     """
 
-    def __init__(self, name='geometric_mean', **kwargs):
+    def __init__(self, name='geometric_mean', num_classes=2, **kwargs):
         super(GeometricMean, self).__init__(name=name, **kwargs)  # handles base args (e.g., dtype)
-        self.args = vars(parser().parse_args())
-        self.num_classes = len(TASK_CLASSES[self.args['task']])
+        self.num_classes = num_classes
         self.total_cm = self.add_weight("total", shape=(self.num_classes, self.num_classes), initializer="zeros")
 
+    def get_config(self):
+        return {**super().get_config(), 'num_classes': self.num_classes}
+
     def reset_state(self):
         for s in self.variables:
             s.assign(tf.zeros(shape=s.shape))
@@ -364,9 +400,11 @@ class GeometricMean(tf.keras.metrics.Metric):
         """
         Make a confusion matrix
         """
-        y_pred = tf.argmax(y_pred, 1)
+        # All-zero labels mark samples a multi-task head does not apply to; leave them out of the matrix.
+        weights = tf.cast(tf.reduce_sum(tf.cast(y_true, tf.float32), axis=1) > 0, dtype=tf.float32)
+        y_pred = tf.argmax(tf.cast(y_pred, tf.float32), 1)  # float16 predictions may tie after rounding
         y_true = tf.argmax(y_true, 1)
-        return tf.math.confusion_matrix(y_true, y_pred, dtype=tf.float32, num_classes=self.num_classes)
+        return tf.math.confusion_matrix(y_true, y_pred, weights=weights, dtype=tf.float32, num_classes=self.num_classes)
 
     def process_confusion_matrix(self):
         """returns gmean"""
@@ -377,3 +415,92 @@ class GeometricMean(tf.keras.metrics.Metric):
 
     def fill_output(self, output):
         output['g_mean'] = self.result()
+
+
+class ScoreHistogram(tf.keras.metrics.Metric):
+    """
+    Base of the streaming threshold metrics: histograms of the positive class score of the positive and the negative
+    samples over `num_thresholds` equal bins of [0, 1], so a validation pass gives ROC and PR curves without storing
+    the predictions. Binary heads only. Samples count by their `sample_weight`, and all-zero labels (samples a
+    multi-task head does not apply to) add nothing.
+    """
+
+    def __init__(self, name, num_thresholds=200, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.num_thresholds = num_thresholds
+        self.pos_hist = self.add_weight('pos_hist', shape=(num_thresholds,), initializer='zeros')
+        self.neg_hist = self.add_weight('neg_hist', shape=(num_thresholds,), initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.cast(y_true, tf.float32)
+        if sample_weight is not None:
+            y_true = y_true * tf.reshape(tf.cast(sample_weight, tf.float32), [-1, 1])
+        bins = tf.clip_by_value(tf.cast(tf.cast(y_pred[:, 1], tf.float32) * self.num_thresholds, tf.int32),
+                                0, self.num_thresholds - 1)
+        self.pos_hist.assign_add(tf.math.unsorted_segment_sum(y_true[:, 1], bins, self.num_thresholds))
+        self.neg_hist.assign_add(tf.math.unsorted_segment_sum(y_true[:, 0], bins, self.num_thresholds))
+
+    def reset_state(self):
+        for s in self.variables:
+            s.assign(tf.zeros(shape=s.shape))
+
+    def rates(self):
+        """TPR and FPR at thresholds i / num_thresholds, plus a last point above 1."""
+        tp = tf.concat([tf.math.cumsum(self.pos_hist, reverse=True), [0.]], axis=0)
+        fp = tf.concat([tf.math.cumsum(self.neg_hist, reverse=True), [0.]], axis=0)
+        return tf.math.divide_no_nan(tp, tp[0]), tf.math.divide_no_nan(fp, fp[0]), tp, fp
+
+    def get_config(self):
+        return {**super().get_config(), 'num_thresholds': self.num_thresholds}
+
+
+class RocAuc(ScoreHistogram):
+    def __init__(self, name='roc_auc', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+    def result(self):
+        tpr, fpr, _, _ = self.rates()
+        return tf.reduce_sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2.)  # Trapezoidal
+
+
+class AveragePrecision(ScoreHistogram):
+    def __init__(self, name='average_precision', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+    def result(self):
+        recall, _, tp, fp = self.rates()
+        precision = tf.math.divide_no_nan(tp, tp + fp)
+        return tf.reduce_sum((recall[:-1] - recall[1:]) * precision[:-1])  # Step-wise, as average_precision_score
+
+
+class DistanceThreshold(ScoreHistogram):
+    """Threshold with the minimum distance of the ROC curve from (0,1), as `dist_thresh` of calc_metrics."""
+
+    def __init__(self, name='dist_threshold', **kwargs):
+        super().__init__(name=name, **kwargs)
+
+    def result(self):
+        tpr, fpr, _, _ = self.rates()
+        dist = tf.math.sqrt(tf.math.square(fpr[:-1]) + tf.math.square(1. - tpr[:-1]))
+        return tf.cast(tf.argmin(dist), tf.float32) / self.num_thresholds
+
+
+class SensitivityAtSpecificity(ScoreHistogram):
+    def __init__(self, name='sens_at_spec', specificity=.9, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.specificity = specificity
+
+    def result(self):
+        tpr, fpr, _, _ = self.rates()
+        return tf.reduce_max(tf.where(1. - fpr[:-1] >= self.specificity, tpr[:-1], 0.))
+
+    def get_config(self):
+        return {**super().get_config(), 'specificity': self.specificity}
+
+
+def threshold_metrics(args):
+    return [RocAuc(), AveragePrecision(), DistanceThreshold(), SensitivityAtSpecificity(specificity=args['specificity'])]
+
+
+STREAMING_METRICS = {'RocAuc': RocAuc, 'AveragePrecision': AveragePrecision, 'DistanceThreshold': DistanceThreshold,
+                     'SensitivityAtSpecificity': SensitivityAtSpecificity}
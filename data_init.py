@@ -1,121 +1,143 @@
 import os
+import json
+import hashlib
+import argparse
 import numpy as np
 import pandas as pd
 from settings import INIT_DATA_DIR, INFO_DIR, data_csv
 from features_def import COLUMNS, DATA_MAP
-NP_RNG = np.random.default_rng(seed=1312)
-isic18_val = pd.read_csv(os.path.join(INIT_DATA_DIR, 'isic18_val.csv'))
-[isic18_val.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in isic18_val.columns]
-isic18_val = isic18_val[COLUMNS]
-isic19 = pd.read_csv(os.path.join(INIT_DATA_DIR, 'isic19.csv'))
-[isic19.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in isic19.columns]
-isic19 = isic19[COLUMNS]
-isic20 = pd.read_csv(os.path.join(INIT_DATA_DIR, 'isic20.csv'))
-[isic20.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in isic20.columns]
-isic20 = isic20[COLUMNS]
-isic20_duplicates = pd.read_csv(os.path.join(INIT_DATA_DIR, 'ISIC_2020_Training_Duplicates.csv'))
-isic20_duplicates['image_name_2'] = isic20_duplicates['image_name_2'] + '.jpg'
-isic20.drop(isic20[isic20['image'].isin(isic20_duplicates['image_name_2'])].index, errors='ignore', inplace=True)
-mednode = pd.read_csv(os.path.join(INIT_DATA_DIR, 'mednode.csv'))
-[mednode.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in mednode.columns]
-mednode = mednode[COLUMNS]
-
-spt = pd.read_csv(os.path.join(INIT_DATA_DIR, '7pt.csv'))
-[spt.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in spt.columns]
-spt = spt[COLUMNS]
-spt_val_idx = pd.read_csv(os.path.join(INIT_DATA_DIR, '7pt', 'meta', 'valid_indexes.csv'))
-spt_val_idx.index = spt_val_idx['indexes']
-spt_test_idx = pd.read_csv(os.path.join(INIT_DATA_DIR, '7pt', 'meta', 'test_indexes.csv'))
-spt_test_idx.index = spt_test_idx['indexes']
-dermofit = pd.read_csv(os.path.join(INIT_DATA_DIR, 'dermofit.csv'))
-[dermofit.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in dermofit.columns]
-dermofit = dermofit[COLUMNS]
-ph2 = pd.read_csv(os.path.join(INIT_DATA_DIR, 'ph2.csv'))
-[ph2.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in ph2.columns]
-ph2 = ph2[COLUMNS]
-up = pd.read_csv(os.path.join(INIT_DATA_DIR, 'up.csv'))
-[up.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in up.columns]
-up = up[COLUMNS]
-padufes = pd.read_csv(os.path.join(INIT_DATA_DIR, 'padufes.csv'))
-padufes_ids = padufes["patient_id"].unique()
-NP_RNG.shuffle(padufes_ids)
-padufes_train = padufes.loc[padufes["patient_id"].isin(padufes_ids[:int(len(padufes_ids) * 0.9)])]
-padufes_val = padufes.loc[padufes["patient_id"].isin(padufes_ids[int(len(padufes_ids) * 0.9):])]
-
-isic16_test = pd.read_csv(os.path.join(INIT_DATA_DIR, 'isic16_test.csv'))
-[isic16_test.insert(loc=0, column=column, value=value) for column, value in zip(COLUMNS, ['none', 'none', 'none', 'none', 'none', 'none', 0., 'none', 'none']) if column not in isic16_test.columns]
-isic16_test = isic16_test[COLUMNS]
-isic17_test = pd.read_csv(os.path.join(INIT_DATA_DIR, 'isic17_test.csv'))
-[isic17_test.insert(loc=0, column=column, value=value) for column, value in zip(COLUMNS, ['none', 'none', 'none', 'none', 'none', 'none', 0., 'none', 'none']) if column not in isic17_test.columns]
-isic17_test = isic17_test[COLUMNS]
-isic20_test = pd.read_csv(os.path.join(INIT_DATA_DIR, 'isic20_test.csv'))
-
-mclass_clinic_test = pd.read_csv(os.path.join(INIT_DATA_DIR, 'mclass_clinic_test.csv'))
-[mclass_clinic_test.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in mclass_clinic_test.columns]
-mednode.drop(mednode[mednode['image'].isin(mclass_clinic_test['image'])].index, errors='ignore', inplace=True)
-mclass_derm_test = pd.read_csv(os.path.join(INIT_DATA_DIR, 'mclass_derm_test.csv'))
-[mclass_derm_test.insert(loc=0, column=column, value=None) for column in COLUMNS if column not in mclass_derm_test.columns]
-
-nans_isic19 = isic19[isic19["lesion_id"].isna()]
-isic19_not_nans = isic19[~isic19.index.isin(nans_isic19.index)]
-isic19_ids = isic19_not_nans["lesion_id"].unique()
-NP_RNG.shuffle(isic19_ids)
-isic19_train = isic19.loc[isic19["lesion_id"].isin(isic19_ids[:int(len(isic19_ids) * 0.9)])].append(nans_isic19)
-isic19_val = isic19.loc[isic19["lesion_id"].isin(isic19_ids[int(len(isic19_ids) * 0.9):])]  # int(len(isic19_ids) * 0.9)
-isic20_ids = isic20["patient_id"].unique()
-NP_RNG.shuffle(isic20_ids)
-isic20_train = isic20.loc[isic20["patient_id"].isin(isic20_ids[:int(len(isic20_ids) * 0.9)])]
-isic20_val = isic20.loc[isic20["patient_id"].isin(isic20_ids[int(len(isic20_ids) * 0.9):])]
-spt_test = spt[spt.index.isin(spt_test_idx.index)]
-spt_val = spt[spt.index.isin(spt_val_idx.index)].append(spt_test)
-spt_train = spt[~spt.index.isin(spt_val.index)]
-mednode_train = mednode.sample(frac=0.9, random_state=NP_RNG.bit_generator)
-mednode_val = mednode[~mednode.index.isin(mednode_train.index)]
-ph2_train = ph2.sample(frac=0.9, random_state=NP_RNG.bit_generator)
-ph2_val = ph2[~ph2.index.isin(ph2_train.index)]
-
-total_train = padufes_train.append(isic19_train).append(isic20_train).append(spt_train).append(mednode_train).append(ph2_train)
-total_val = padufes_val.append(isic19_val).append(isic20_val).append(spt_val).append(mednode_val).append(ph2_val)
-total_test = isic18_val.append(dermofit).append(up).append(isic16_test).append(isic17_test).append(mclass_clinic_test).append(mclass_derm_test)
-total_data_len = len(total_train) + len(total_val) + len(total_test)
-
-
-for df, save_to in [(total_train, data_csv['train']), (total_val, data_csv['validation']), (total_test, data_csv['test']),
-                    (isic16_test, data_csv['isic16_test']), (isic17_test, data_csv['isic17_test']), (isic20_test, data_csv['isic20_test']),
-                    (isic18_val, data_csv['isic18_val_test']), (dermofit, data_csv['dermofit_test']), (up, data_csv['up_test']),
-                    (mclass_clinic_test, data_csv['mclass_clinic_test']), (mclass_derm_test, data_csv['mclass_derm_test'])]:
-    if save_to in (data_csv['train'], data_csv['validation'], data_csv['test']):
-        df = df.sample(frac=1., random_state=NP_RNG.bit_generator)
-    columns = ['dataset_id', 'location', 'sex', 'image', 'age_approx', 'image_type', 'class']
+
+# Builds the dataset CSVs of settings.data_csv from the source CSVs in data/. Every source is normalised once and cached
+# in data/cache/ under the hash of its input files, so only changed sources are read again. Train and validation are
+# split per patient or lesion by a stable hash of its ID, so adding or changing a source moves no samples of the others.
+#   python data_init.py           # Rebuild the changed sources
+#   python data_init.py -force    # Rebuild every source
+
+CACHE_DIR = os.path.join(INIT_DATA_DIR, 'cache')
+BUILD_VERSION = 1  # Bump when normalise() changes, to rebuild the cached sources
+VAL_FRAC = 0.1
+SEED = 1312
+# Split of every source: by the hash of an ID column, the official 7pt indexes or test only. Extra input files count
+# towards the source's cache hash.
+SOURCES = {'padufes': {'split': 'patient_id'},
+           'isic19': {'split': 'lesion_id'},  # Images without lesion ID go to train
+           'isic20': {'split': 'patient_id', 'inputs': ['ISIC_2020_Training_Duplicates.csv']},
+           '7pt': {'split': 'official', 'inputs': [os.path.join('7pt', 'meta', 'valid_indexes.csv'),
+                                                   os.path.join('7pt', 'meta', 'test_indexes.csv')]},
+           'mednode': {'split': 'image', 'inputs': ['mclass_clinic_test.csv']},
+           'ph2': {'split': 'image'},
+           'isic18_val': {'split': 'test'},
+           'dermofit': {'split': 'test'},
+           'up': {'split': 'test'},
+           'isic16_test': {'split': 'test', 'fill': 'none'},
+           'isic17_test': {'split': 'test', 'fill': 'none'},
+           'mclass_clinic_test': {'split': 'test'},
+           'mclass_derm_test': {'split': 'test'},
+           'isic20_test': {'split': 'test'}}
+TEST_SOURCES = ['isic18_val', 'dermofit', 'up', 'isic16_test', 'isic17_test', 'mclass_clinic_test', 'mclass_derm_test']
+SINGLE_TESTS = {'isic16_test': 'isic16_test', 'isic17_test': 'isic17_test', 'isic20_test': 'isic20_test',
+                'isic18_val_test': 'isic18_val', 'dermofit_test': 'dermofit', 'up_test': 'up',
+                'mclass_clinic_test': 'mclass_clinic_test', 'mclass_derm_test': 'mclass_derm_test'}
+
+
+def stable_split(source, ids, val_frac=VAL_FRAC):
+    """'validation' for the IDs hashed into the first `val_frac` of the hash range, 'train' for the rest and missing IDs."""
+    buckets = ids.map(lambda value: int(hashlib.md5(f'{source}/{value}'.encode()).hexdigest()[:8], 16) / 16 ** 8,
+                      na_action='ignore')
+    return np.where(buckets < val_frac, 'validation', 'train')
+
+
+def normalise(name):
+    """Source CSV with COLUMNS and its split, ages in decades, image paths in the dataset folder and mapped values."""
+    spec = SOURCES[name]
+    df = pd.read_csv(os.path.join(INIT_DATA_DIR, f'{name}.csv'))
+    if name == 'isic20':  # Duplicate images of the ISIC 2020 training set
+        duplicates = pd.read_csv(os.path.join(INIT_DATA_DIR, 'ISIC_2020_Training_Duplicates.csv'))
+        df = df[~df['image'].isin(duplicates['image_name_2'] + '.jpg')]
+    if name == 'mednode':  # Images of the MClass clinical test set
+        df = df[~df['image'].isin(pd.read_csv(os.path.join(INIT_DATA_DIR, 'mclass_clinic_test.csv'))['image'])]
+    for column in COLUMNS:
+        if column not in df.columns:
+            df[column] = (0. if column == 'age_approx' else spec['fill']) if 'fill' in spec else None
+    if spec['split'] == 'test':
+        split = 'test'
+    elif spec['split'] == 'official':  # Both the validation and the test indexes of 7pt go to validation
+        indexes = pd.concat([pd.read_csv(os.path.join(INIT_DATA_DIR, path))['indexes'] for path in spec['inputs']])
+        split = np.where(df.index.isin(indexes), 'validation', 'train')
+    else:
+        split = stable_split(name, df[spec['split']])
+    df = df[COLUMNS].assign(split=split)
+    df['age_approx'] = pd.to_numeric(df['age_approx'], errors='coerce')
     df['age_approx'] -= (df['age_approx'] % 10)
-    df['image'] = df[['dataset_id', 'image']].apply(lambda id_img: os.path.join(id_img[0], 'data', id_img[1]), axis=1)
-    df.replace(to_replace=DATA_MAP, inplace=True)
-
-    print("{}| Count:{} Ratio:{}".format(os.path.split(save_to)[-1].rjust(25), str(len(df)).rjust(6), str(round(len(df) / total_data_len, 3)).rjust(6)))
-    if os.path.basename(save_to).split('.')[0] == 'isic20_test':
-        columns.remove('class')
-    df.to_csv(save_to, index=False, columns=columns)
-
-    # log datasets description
-    dataset_info_dict = {}
-    image_type_inv = {}
-    if os.path.basename(save_to).split('.')[0] != 'isic20_test':
-        for dataset_id in df['dataset_id'].unique():
-            dataset_part = df[df.loc[:, 'dataset_id'] == dataset_id]  # fraction per class
-            dataset_img_type_dict = {}
-            for image_type in dataset_part['image_type'].unique():
-                dataset_image_part = dataset_part[dataset_part.loc[:, 'image_type'] == image_type]
-                dataset_image_part = dataset_image_part.drop(dataset_image_part[dataset_image_part['class'] == 5].index, errors='ignore')
-                dataset_class_dict = {}
-                for k, v in dataset_image_part['class'].value_counts().items():
-                    dataset_class_dict[k] = v
-                dataset_img_type_dict[image_type] = dataset_class_dict
-
-            dataset_info_dict[dataset_id] = dataset_img_type_dict
-        info = pd.DataFrame(dataset_info_dict).stack().apply(pd.Series)
-        info = info[sorted(info.columns)]
-        info.fillna(0, inplace=True)
-        save_path = os.path.join(INFO_DIR, os.path.basename(save_to).split('.')[0]+'_info')
+    df['image'] = [os.path.join(dataset_id, 'data', image) for dataset_id, image in zip(df['dataset_id'], df['image'])]
+    return df.replace(to_replace=DATA_MAP)
+
+
+def source_hash(name):
+    # The normalised sources are cut to COLUMNS and mapped with DATA_MAP, so changes to either rebuild them too
+    md5 = hashlib.md5(f'{BUILD_VERSION}/{VAL_FRAC}/{SOURCES[name]}/{COLUMNS!r}/{DATA_MAP!r}'.encode())
+    for path in [f'{name}.csv'] + SOURCES[name].get('inputs', []):
+        with open(os.path.join(INIT_DATA_DIR, path), 'rb') as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+def load_sources(force=False):
+    """Normalised sources, from the cache unless their input files changed."""
+    manifest_path = os.path.join(CACHE_DIR, 'manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    sources = {}
+    for name in SOURCES:
+        digest, cache_path = source_hash(name), os.path.join(CACHE_DIR, f'{name}.pkl')
+        if manifest.get(name) == digest and os.path.isfile(cache_path):
+            sources[name] = pd.read_pickle(cache_path)
+        else:
+            print(f"Normalising {name}...")
+            sources[name] = normalise(name)
+            sources[name].to_pickle(cache_path)
+            manifest[name] = digest
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return sources
+
+
+def dataset_info(df):
+    """Samples per image type, dataset and class."""
+    df = df.drop(df[df['class'] == 5].index, errors='ignore')
+    return df.groupby(['image_type', 'dataset_id'])['class'].value_counts().unstack(fill_value=0).sort_index(axis=1)
+
+
+def build(force=False):
+    sources = load_sources(force=force)
+    train_val = pd.concat([df for name, df in sources.items() if SOURCES[name]['split'] != 'test'], ignore_index=True)
+    outputs = {data_csv['train']: train_val[train_val['split'] == 'train'],
+               data_csv['validation']: train_val[train_val['split'] == 'validation'],
+               data_csv['test']: pd.concat([sources[name] for name in TEST_SOURCES], ignore_index=True)}
+    outputs = {save_to: df.sample(frac=1., random_state=SEED) for save_to, df in outputs.items()}
+    total_data_len = sum(len(df) for df in outputs.values())
+    outputs.update({data_csv[key]: sources[name] for key, name in SINGLE_TESTS.items()})
+
+    for save_to, df in outputs.items():
+        columns = ['dataset_id', 'location', 'sex', 'image', 'age_approx', 'image_type', 'class']
+        print("{}| Count:{} Ratio:{}".format(os.path.split(save_to)[-1].rjust(25), str(len(df)).rjust(6), str(round(len(df) / total_data_len, 3)).rjust(6)))
+        if os.path.basename(save_to).split('.')[0] == 'isic20_test':
+            columns.remove('class')
+            df.to_csv(save_to, index=False, columns=columns)
+            continue
+        df.to_csv(save_to, index=False, columns=columns)
+        # log datasets description
+        save_path = os.path.join(INFO_DIR, os.path.basename(save_to).split('.')[0] + '_info')
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        info = dataset_info(df)
         info.to_html(save_path + '.html', bold_rows=False, border=4)
         info.to_csv(save_path + '.csv')
+
+
+if __name__ == '__main__':
+    args_parser = argparse.ArgumentParser(description='Build the dataset CSVs from the source CSVs.')
+    args_parser.add_argument('--force', '-force', action='store_true', help='Rebuild every source, ignoring the cache.')
+    build(force=vars(args_parser.parse_args())['force'])
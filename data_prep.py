@@ -8,13 +8,15 @@ from features_def import BEN_MAL_MAP, LOCATIONS, IMAGE_TYPE, SEX, AGE_APPROX, TA
 from settings import data_csv
 
 
-def _prep_df(args, dataset: str, dirs):
+def _prep_df(args, dataset: str, dirs, subset=1.):
     df = pd.read_csv(data_csv[dataset])
     # _log_info(args, dataset, df, dirs)
 
     if float(args['dataset_frac']) != 1.:
-        if dataset in ('train', 'validation'):
+        if dataset == 'train':
             df = df.sample(frac=args['dataset_frac'])
+        elif dataset == 'validation':  # The same subset for every trial, e.g. so that sweep trials compare fairly
+            df = df.sample(frac=args['dataset_frac'], random_state=0)
     else:
         if dataset in 'train':
             df = df.sample(frac=args['dataset_frac'])
@@ -28,7 +30,7 @@ def _prep_df(args, dataset: str, dirs):
     df['age_approx'] = df['age_approx'].astype(int).astype('string')
     # df['age_approx'] = df['age_approx']
     # Define classes according to task
-    if 'class' in df.columns:
+    if 'class' in df.columns and not args['multi_task']:  # Multi-task keeps all classes and masks per head
         if args['task'] == 'ben_mal':
             df = df.replace(to_replace=BEN_MAL_MAP)
         if args['task'] == 'nev_mel':
@@ -44,11 +46,16 @@ def _prep_df(args, dataset: str, dirs):
     else:  # Keep dermoscopy or clinical image samples for the rest datasets according to training image type
         if args['image_type'] != 'both':
             df = df.drop(df[~df['image_type'].isin([args['image_type']])].index, errors='ignore')
+    if subset < 1.:  # Fixed subset per class, image type and dataset, at least one sample of each
+        df = df.groupby(['class', 'image_type', 'dataset_id'], group_keys=False).apply(
+            lambda stratum: stratum.sample(n=max(int(round(len(stratum) * subset)), 1), random_state=0))
     return df
 
 
-def _prep_df_for_tfdataset(args, dataset, dirs):
-    df = _prep_df(args, dataset, dirs)
+def _prep_df_for_tfdataset(args, dataset, dirs, subset=1.):
+    df = _prep_df(args, dataset, dirs, subset=subset)
+    if args['multi_task']:
+        return _prep_df_for_multitask(args, dataset, df)
     categories = [LOCATIONS, SEX, AGE_APPROX]
     columns = ['location', 'sex', 'age_approx']
     if not args['no_image_type']:
@@ -56,6 +63,8 @@ def _prep_df_for_tfdataset(args, dataset, dirs):
         columns.append('image_type')
     categories.append(TASK_CLASSES[args['task']])
     columns.append('class')
+    if 'class' not in df.columns:  # Unlabelled isic20_test: placeholder class, only the features are used
+        df['class'] = TASK_CLASSES[args['task']][0]
     features_env = OneHotEncoder(handle_unknown='ignore', categories=categories)
     features_env.fit(df[columns])
     ohe_data = features_env.transform(df[columns]).toarray()
@@ -85,59 +94,278 @@ def _prep_df_for_tfdataset(args, dataset, dirs):
     return df['image'].values, clinical_data, ohe_data[:, -2:], sample_weight
 
 
+def _multitask_labels(df):
+    """One-hot label per task head. Samples outside a task's classes (e.g. UNK for 5cls) get an all-zero label."""
+    labels = {}
+    for task, class_names in TASK_CLASSES.items():
+        task_class = df['class'].replace(to_replace=BEN_MAL_MAP['class']) if task == 'ben_mal' else df['class']
+        labels[f'class_{task}'] = pd.get_dummies(pd.Categorical(task_class, categories=class_names)).values.astype(np.float32)
+    return labels
+
+
+def _prep_df_for_multitask(args, dataset, df):
+    categories = [LOCATIONS, SEX, AGE_APPROX]
+    columns = ['location', 'sex', 'age_approx']
+    if not args['no_image_type']:
+        categories.append(IMAGE_TYPE)
+        columns.append('image_type')
+    clinical_data = OneHotEncoder(handle_unknown='ignore', categories=categories).fit_transform(df[columns]).toarray()
+    if 'class' not in df.columns:
+        return df['image'].values, clinical_data, None, None
+    labels = _multitask_labels(df)
+    # Per head sample weights double as loss masks: zero for samples the head does not apply to.
+    sample_weight = {head: np.sum(label, axis=-1) for head, label in labels.items()}
+    if dataset == 'train':
+        if args['image_type'] == 'both' and args['weighted_samples']:  # Sample weight for image type
+            image_type_ohe = OneHotEncoder(handle_unknown='ignore', categories=[IMAGE_TYPE]).fit_transform(df[['image_type']]).toarray()
+            image_type_weight = np.divide(np.amax(np.sum(image_type_ohe, axis=0)), np.sum(image_type_ohe, axis=0))
+            image_type_weight = np.sum(np.multiply(image_type_weight, image_type_ohe), axis=-1)
+            sample_weight = {head: mask * image_type_weight for head, mask in sample_weight.items()}
+        if args['weighted_loss']:  # Class weight per head
+            for head, label in labels.items():
+                class_weight = np.divide(np.amax(np.sum(label, axis=0)), np.maximum(np.sum(label, axis=0), 1.))
+                sample_weight[head] = sample_weight[head] * np.sum(np.multiply(class_weight, label), axis=-1)
+    sample_weight = {head: weight.astype(np.float32) for head, weight in sample_weight.items()}
+    #      image_path,         clinical_data, class per head, sample weight per head
+    return df['image'].values, clinical_data, labels, sample_weight
+
+
+def _autotune(args, key):
+    """tf.data.AUTOTUNE unless a fixed value is set with --num-parallel-calls or --prefetch."""
+    return args[key] if args.get(key, 0) > 0 else tf.data.AUTOTUNE
+
+
+def _worker_shard(args, *arrays):
+    """
+    This worker's share of the samples under the multiworker strategy, taken before decoding so that no worker reads
+    the others' images, and trimmed to equal sizes so that all workers run the same number of steps.
+    """
+    num_workers = args.get('num_workers', 1) if args['strategy'] == 'multiworker' else 1
+    if num_workers == 1:
+        return arrays
+    index = np.arange(args['worker_index'], len(arrays[0]) // num_workers * num_workers, num_workers)
+    return tuple(None if array is None else {key: value[index] for key, value in array.items()}
+                 if isinstance(array, dict) else array[index] for array in arrays)
+
+
+def _dataset_options(args):
+    """
+    Files are sharded by _worker_shard under the multiworker strategy, by element otherwise. The CPU strategy may give
+    the pipelines a private threadpool, apart from the ops of the model.
+    """
+    options = tf.data.Options()
+    if args['strategy'] == 'cpu' and args['data_threads']:
+        options.threading.private_threadpool_size = args['data_threads']
+    if args['strategy'] == 'multiworker' and args.get('num_workers', 1) > 1:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    else:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    return options
+
+
 def _read_images(image):
     return tf.cast(x=tf.io.decode_image(tf.io.read_file(tf.squeeze(image)), channels=3), dtype=tf.float32)
 
 
-def get_train_dataset(args, dirs):
-    rng = tf.random.Generator.from_non_deterministic_state()
-    image_path, onehot_features, onehot_label, sample_weight = _prep_df_for_tfdataset(args, 'train', dirs)
-    image_path_ds = tf.data.Dataset.from_tensor_slices(image_path)
-    images_ds = image_path_ds.map(_read_images, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    image_path_ds = image_path_ds.batch(args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    images_ds = images_ds.batch(args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    images_ds = images_ds.map(lambda sample: augm(sample, args, rng), num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    onehot_features_ds = tf.data.Dataset.from_tensor_slices(onehot_features).batch(args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    onehot_label_ds = tf.data.Dataset.from_tensor_slices(onehot_label).batch(args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    sample_weight_ds = tf.data.Dataset.from_tensor_slices(sample_weight).batch(args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    ds = tf.data.Dataset.zip((image_path_ds, images_ds, onehot_features_ds, onehot_label_ds, sample_weight_ds))
-    ds = ds.map(lambda a, b, c, d, e: ({'image_path': a, 'image': b, 'clinical_data': c}, {'class': d}, e))
-    # ds = ds.batch(args['batch_size'] * args['gpus'], deterministic=True)
-    options = tf.data.Options()
-    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
-    ds = ds.with_options(options)
-    return ds.prefetch(tf.data.AUTOTUNE)
+def _decode_scaled(contents, size):
+    """JPEGs decoded at the smallest DCT scale, 1/8 to 1/1, whose longest side is still at least `size`. Other formats,
+    e.g. the PNG and BMP images of some datasets, at full size."""
+    def decode_jpeg():
+        longest = tf.reduce_max(tf.io.extract_jpeg_shape(contents)[:2])
+        scale = tf.reduce_sum(tf.cast(tf.constant([2, 4, 8]) * size <= longest, tf.int32))
+        return tf.switch_case(scale, [lambda ratio=ratio: tf.io.decode_jpeg(contents, channels=3, ratio=ratio) for ratio in (1, 2, 4, 8)])
+    return tf.cond(tf.io.is_jpeg(contents), decode_jpeg, lambda: tf.io.decode_image(contents, channels=3, expand_animations=False))
+
+
+def _resize_longest(image, size):
+    """Longest side resized to `size` with nearest neighbours, as resize_img of prepare_images."""
+    shape = tf.cast(tf.shape(image)[:2], tf.float32)
+    return tf.image.resize(image, tf.maximum(tf.cast(tf.round(shape * size / tf.reduce_max(shape)), tf.int32), 1), method='nearest')
+
+
+def _read_original(image, image_size, hair_removal=False):
+    """
+    Original image from data/ processed as hair_removal_and_resize of prepare_images does for proc_{size}, in the input
+    pipeline: resized and zero padded to a square, with the odd pixel of padding on the top or left side.
+    hair_removal: remove hair at 500 pixels first as prepare_images does, on the CPU with OpenCV.
+    """
+    contents = tf.io.read_file(tf.squeeze(image))
+    if hair_removal:
+        from prepare_images import hair_removal as remove_hair
+        image = _resize_longest(_decode_scaled(contents, 500), 500)
+        # Channels reversed to the BGR order prepare_images gets from cv2.imread
+        image = tf.numpy_function(lambda rgb: remove_hair(np.ascontiguousarray(rgb[..., ::-1]))[..., ::-1], [image], tf.uint8)
+        image = _resize_longest(tf.ensure_shape(image, [None, None, 3]), image_size)
+    else:
+        image = _resize_longest(_decode_scaled(contents, image_size), image_size)
+    offset = (image_size - tf.shape(image)[:2] + 1) // 2
+    return tf.cast(tf.image.pad_to_bounding_box(image, offset[0], offset[1], image_size, image_size), dtype=tf.float32)
 
 
-def get_val_test_dataset(args, dataset, dirs):
-    image_path, onehot_features, onehot_label, sample_weight = _prep_df_for_tfdataset(args, dataset, dirs)
+def _image_reader(args, image_size=None):
+    """Image path to image map function: reads proc_{size} or, with --from-originals, processes the original image."""
+    if args['from_originals']:
+        return lambda image: _read_original(image, image_size or args['image_size'], hair_removal=args['hair_removal'])
+    return _read_images
+
+
+def _strata(args, dirs, image_path):
+    """Task class and image type of every training image path, e.g. MAL_clinic, the streams of balanced sampling."""
+    df = pd.read_csv(data_csv['train'], usecols=['image', 'class', 'image_type']).drop_duplicates(subset='image')
+    df['image'] = df['image'].apply(lambda x: os.path.join(dirs['proc_img_folder'], x))
+    if args['task'] == 'ben_mal':
+        df = df.replace(to_replace=BEN_MAL_MAP)
+    df = df.fillna('').set_index('image').loc[image_path]
+    return (df['class'] + '_' + df['image_type']).values
+
+
+def _balanced_samples(args, dirs, samples):
+    """
+    Samples drawn from endless shuffled streams per (class, image type), in proportions of stream size to the power of
+    --sampling-power, cut to epochs of --steps-per-epoch batches.
+    """
+    strata = _strata(args, dirs, samples[0])
+    names, counts = np.unique(strata, return_counts=True)
+    proportions = np.power(counts, args['sampling_power']) / np.sum(np.power(counts, args['sampling_power']))
+    print('Balanced sampling: ' + ', '.join(f'{name} {count} samples at {proportion:.1%}'
+                                            for name, count, proportion in zip(names, counts, proportions)))
+    streams = [tf.data.Dataset.from_tensor_slices(tf.nest.map_structure(lambda array: array[strata == name], samples))
+               .shuffle(count).repeat() for name, count in zip(names, counts)]
+    batch_size = args['batch_size'] * args['gpus'] * args['accumulate_steps']
+    steps = args['steps_per_epoch'] or max(len(strata) // batch_size, 1)
+    return tf.data.experimental.sample_from_datasets(streams, weights=proportions.tolist()).take(steps * batch_size)
+
+
+def teacher_predictions(args, dirs, teacher):
+    """
+    Teacher class probabilities for every training image, indexed by image path. Cached in the teacher's folder and
+    only computed for images missing from the cache, so the teacher runs once per image across trials.
+    """
+    cache_path = os.path.join(dirs['load_path'], f"teacher_pred_{args['task']}_{args['image_size']}{'_orig' if args['from_originals'] else ''}.csv")
+    class_names = TASK_CLASSES[args['task']]
+    if os.path.isfile(cache_path):
+        cache = pd.read_csv(cache_path, index_col='image')
+        cache = cache[~cache.index.duplicated()]
+    else:
+        cache = pd.DataFrame(columns=class_names, index=pd.Index([], name='image'), dtype=np.float32)
+    # Full training set regardless of dataset fraction, so that any later subsample is covered.
+    image_path, clinical_data, _, _ = _prep_df_for_tfdataset({**args, 'dataset_frac': 1.}, 'train', dirs)
+    image_names = pd.Index([os.path.relpath(path, dirs['proc_img_folder']) for path in image_path])
+    missing = ~image_names.isin(cache.index) & ~image_names.duplicated()  # The train CSV repeats a few images
+    if np.any(missing):
+        print(f"Predicting {np.sum(missing)} training images with the teacher...")
+        batch_size = 50 * args['batch_size'] * args['gpus']
+        images_ds = tf.data.Dataset.from_tensor_slices(image_path[missing]).map(_image_reader(args), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+        clinical_data_ds = tf.data.Dataset.from_tensor_slices(clinical_data[missing])
+        ds = tf.data.Dataset.zip((images_ds, clinical_data_ds)).batch(batch_size)
+        ds = ds.map(lambda a, b: {'image': a, 'clinical_data': b}).prefetch(_autotune(args, 'prefetch'))
+        cache = pd.concat([cache, pd.DataFrame(teacher.predict(ds), index=image_names[missing], columns=class_names)])
+        cache.to_csv(cache_path, index_label='image')
+    teacher_pred = pd.DataFrame(cache.reindex(image_names).values, index=image_path, columns=class_names)
+    return teacher_pred[~teacher_pred.index.duplicated()]
+
+
+def get_train_dataset(args, dirs, teacher_pred=None, image_size=None, rng=None, mining=None):
+    """
+    image_size: train at this size instead of --image-size by resizing the processed images (progressive resizing).
+    rng: generator of the augmentations, e.g. one that is checkpointed to resume training.
+    mining: HardExampleMining callback that draws the samples of every epoch.
+    """
+    if rng is None:
+        rng = tf.random.Generator.from_non_deterministic_state()
+    # The sampler balances the streams in place of the image type and class weights, multi-task masks are kept
+    prep_args = {**args, 'weighted_samples': False, 'weighted_loss': False} if args['balanced_sampling'] else args
+    image_path, onehot_features, onehot_label, sample_weight = _worker_shard(args, *_prep_df_for_tfdataset(prep_args, 'train', dirs))
+    samples = (image_path, onehot_features, onehot_label, sample_weight)
+    if teacher_pred is not None:  # Cached soft targets for distillation
+        samples += (teacher_pred.reindex(image_path).values.astype(np.float32),)
+    # A single source of all of a sample's tensors, so that tf.data service can split it between workers
+    if args['balanced_sampling']:
+        ds = _balanced_samples(args, dirs, samples)
+    elif mining is not None:  # Indices drawn by the callback from the latest sample losses when every epoch starts
+        batch_size = args['batch_size'] * args['gpus'] * args['accumulate_steps']
+        mining.reset(image_path, size=max(int(len(image_path) * args['hard_mining_frac']) // batch_size, 1) * batch_size)
+        samples = tf.nest.map_structure(tf.constant, samples)
+        ds = tf.data.Dataset.from_generator(mining.indices, output_signature=tf.TensorSpec(shape=(), dtype=tf.int64))
+        ds = ds.map(lambda index: tf.nest.map_structure(lambda tensor: tf.gather(tensor, index), samples))
+    else:
+        ds = tf.data.Dataset.from_tensor_slices(samples)
+    ds = ds.map(lambda a, *b: (a, _image_reader(args, image_size)(a), *b), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    if image_size and image_size != args['image_size']:
+        if not args['from_originals']:  # The originals are processed at the stage size already
+            ds = ds.map(lambda a, b, *c: (a, tf.image.resize(tf.ensure_shape(b, [None, None, 3]), (image_size, image_size)), *c), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+        args = {**args, 'image_size': image_size}  # Scale augmentation translations and cutouts to the stage size
+    ds = ds.batch(args['batch_size'] * args['gpus'] * args['accumulate_steps'], num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    if args['data_service']:  # The pipeline runs on the service workers, which cannot share the Generator
+        ds = ds.map(lambda a, b, *c: (a, augm(b, args, StatelessRng(tf.random.uniform([2], maxval=tf.int64.max, dtype=tf.int64))), *c), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    else:
+        ds = ds.map(lambda a, b, *c: (a, augm(b, args, rng), *c), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    ds = ds.map(lambda a, b, c, d, e, *f: ({'image_path': a, 'image': b, 'clinical_data': c, **({'teacher_pred': f[0]} if f else {})}, d if args['multi_task'] else {'class': d}, e))
+    if args['data_service']:
+        ds = ds.apply(tf.data.experimental.service.distribute(processing_mode='distributed_epoch', service=args['data_service']))
+    ds = ds.with_options(_dataset_options(args))
+    return ds.prefetch(_autotune(args, 'prefetch'))
+
+
+class StatelessRng:
+    """The uniform() of tf.random.Generator from stateless ops seeded by `seed`, for pipelines without a Generator."""
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.calls = 0
+
+    def uniform(self, shape, minval=0, maxval=None, dtype=tf.float32):
+        self.calls += 1  # Different numbers for every call of the same traced function
+        return tf.random.stateless_uniform(shape, seed=self.seed + [0, self.calls], minval=minval, maxval=maxval,
+                                           dtype=dtype)
+
+
+def start_data_service(num_workers, port=0, dispatcher=None):
+    """
+    Starts a tf.data service dispatcher on `port`, unless the address of one is given, and `num_workers` workers in
+    this process. Returns the service address and the servers, which stop when they are garbage collected.
+    """
+    servers = []
+    if dispatcher is None:
+        servers.append(tf.data.experimental.service.DispatchServer(tf.data.experimental.service.DispatcherConfig(port=port)))
+        dispatcher = servers[0].target
+    for _ in range(num_workers):
+        servers.append(tf.data.experimental.service.WorkerServer(tf.data.experimental.service.WorkerConfig(
+            dispatcher_address=dispatcher.split('://')[-1])))
+    return dispatcher, servers
+
+
+def get_val_test_dataset(args, dataset, dirs, subset=1.):
+    """subset: fraction of a fixed stratified subset of the samples, e.g. for fast validation during training."""
+    image_path, onehot_features, onehot_label, sample_weight = _worker_shard(args, *_prep_df_for_tfdataset(args, dataset, dirs, subset=subset))
     image_path_ds = tf.data.Dataset.from_tensor_slices(image_path)
-    images_ds = image_path_ds.map(_read_images, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    image_path_ds = tf.data.Dataset.from_tensor_slices(image_path).batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    images_ds = images_ds.batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    images_ds = image_path_ds.map(_image_reader(args), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    image_path_ds = tf.data.Dataset.from_tensor_slices(image_path).batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    images_ds = images_ds.batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
     onehot_features_ds = tf.data.Dataset.from_tensor_slices(onehot_features).batch(50 * args['batch_size'] * args['gpus'], deterministic=True)
     onehot_label_ds = tf.data.Dataset.from_tensor_slices(onehot_label).batch(50 * args['batch_size'] * args['gpus'], deterministic=True)
-    ds = tf.data.Dataset.zip((image_path_ds, images_ds, onehot_features_ds, onehot_label_ds))
-    ds = ds.map(lambda a, b, c, d: ({'image_path': a, 'image': b, 'clinical_data': c}, {'class': d}))
-    options = tf.data.Options()
-    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
-    ds = ds.with_options(options)
-    return ds.prefetch(tf.data.AUTOTUNE)
+    if args['multi_task']:  # Validation masks keep heads' metrics and losses to the samples they apply to
+        sample_weight_ds = tf.data.Dataset.from_tensor_slices(sample_weight).batch(50 * args['batch_size'] * args['gpus'], deterministic=True)
+        ds = tf.data.Dataset.zip((image_path_ds, images_ds, onehot_features_ds, onehot_label_ds, sample_weight_ds))
+        ds = ds.map(lambda a, b, c, d, e: ({'image_path': a, 'image': b, 'clinical_data': c}, d, e))
+    else:
+        ds = tf.data.Dataset.zip((image_path_ds, images_ds, onehot_features_ds, onehot_label_ds))
+        ds = ds.map(lambda a, b, c, d: ({'image_path': a, 'image': b, 'clinical_data': c}, {'class': d}))
+    ds = ds.with_options(_dataset_options(args))
+    return ds.prefetch(_autotune(args, 'prefetch'))
 
 
 def get_isic20_test_dataset(args, dirs):
     image_path, onehot_features, onehot_label, sample_weight = _prep_df_for_tfdataset(args, 'isic20_test', dirs)
     image_path_ds = tf.data.Dataset.from_tensor_slices(image_path)
-    images_ds = image_path_ds.map(_read_images, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    image_path_ds = tf.data.Dataset.from_tensor_slices(image_path).batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    images_ds = images_ds.batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
-    onehot_features_ds = tf.data.Dataset.from_tensor_slices(onehot_features).batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+    images_ds = image_path_ds.map(_image_reader(args), num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    image_path_ds = tf.data.Dataset.from_tensor_slices(image_path).batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    images_ds = images_ds.batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
+    onehot_features_ds = tf.data.Dataset.from_tensor_slices(onehot_features).batch(50 * args['batch_size'] * args['gpus'], num_parallel_calls=_autotune(args, 'num_parallel_calls'), deterministic=True)
     ds = tf.data.Dataset.zip((image_path_ds, images_ds, onehot_features_ds))
     ds = ds.map(lambda a, b, c: ({'image_path': a, 'image': b, 'clinical_data': c}))
-    options = tf.data.Options()
-    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
-    ds = ds.with_options(options)
-    return ds.prefetch(tf.data.AUTOTUNE)
+    ds = ds.with_options(_dataset_options(args))
+    return ds.prefetch(_autotune(args, 'prefetch'))
 
 
 def augm(image, args, rng):
@@ -164,13 +392,16 @@ def augm(image, args, rng):
         mask_width = tf.cast(rng.uniform(shape=[], minval=0, maxval=args['image_size'] * cutout_ratio),
                              dtype=tf.int32) * 2
         image = tfa.image.random_cutout(image, mask_size=(mask_height, mask_width))
-    image = {'xept': tf.keras.applications.xception.preprocess_input,
-                       'incept': tf.keras.applications.inception_v3.preprocess_input,
-                       'effnet0': tf.keras.applications.efficientnet.preprocess_input,
-                       'effnet1': tf.keras.applications.efficientnet.preprocess_input,
-                       'effnet6': tf.keras.applications.efficientnet.preprocess_input
-             }[args['pretrained']](image)
-    return image
+    return preprocess(image, args)
+
+
+def preprocess(image, args):
+    return {'xept': tf.keras.applications.xception.preprocess_input,
+            'incept': tf.keras.applications.inception_v3.preprocess_input,
+            'effnet0': tf.keras.applications.efficientnet.preprocess_input,
+            'effnet1': tf.keras.applications.efficientnet.preprocess_input,
+            'effnet6': tf.keras.applications.efficientnet.preprocess_input
+            }[args['pretrained']](image)
 
 
 def _log_info(args, dataset, df, dirs):
@@ -0,0 +1,111 @@
+import os
+import sys
+import csv
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from settings import MAIN_DIR, TRIALS_DIR, Directories, parser, validate_args
+
+# Hyperparameters sampled for each configuration and the main.py flag that sets them.
+SEARCH_SPACE = {'learning_rate': ('-lr', [1e-6, 5e-6, 1e-5, 5e-5, 1e-4]),
+                'dropout': ('-dor', [0.1, 0.2, 0.3, 0.4]),
+                'l1_reg': ('-l1', [0., 1e-7, 1e-5]),
+                'l2_reg': ('-l2', [0., 1e-7, 1e-5]),
+                'conv_layers': ('-clrs', [32, 64, 128]),
+                'dense_layers': ('-dlrs', [16, 64, 128]),
+                'merge_layers': ('-mlrs', [128, 256, 512]),
+                'optimizer': ('-opt', ['adam', 'adamax', 'nadam']),
+                'loss_fn': ('-loss', ['cxe', 'focal'])}
+MONITOR = 'val_geometric_mean'
+
+
+def search_parser():
+    args_parser = argparse.ArgumentParser(description='Successive halving search over main.py configurations.',
+                                          allow_abbrev=False)
+    args_parser.add_argument('--sweep-id', '-sid', type=str, default=datetime.now().strftime('%d%m%y%H%M%S'),
+                             help='Sweep identifier, used as prefix of every trial id.')
+    args_parser.add_argument('--num-configs', '-ncfg', type=int, default=27, help='Configurations in the first rung.')
+    args_parser.add_argument('--eta', '-eta', type=int, default=3,
+                             help='Reduction factor. Top 1/eta configurations of a rung are promoted.')
+    args_parser.add_argument('--rungs', '-rungs', type=int, default=3, help='Number of rungs.')
+    args_parser.add_argument('--min-frac', '-minf', type=float, default=0.1, help='Dataset fraction of first rung.')
+    args_parser.add_argument('--min-epochs', '-mine', type=int, default=3, help='Epochs of first rung.')
+    args_parser.add_argument('--max-epochs', '-maxe', type=int, default=100, help='Epochs upper bound of any rung.')
+    args_parser.add_argument('--from-log', '-log', action='store_true',
+                             help='Take configurations from hparams_log.csv instead of sampling the search space.')
+    args_parser.add_argument('--seed', '-seed', type=int, default=1312, help='Seed for sampling configurations.')
+    return args_parser
+
+
+def rung_budgets(search_args):
+    """Dataset fraction and epochs per rung, both growing by eta up to the full budget."""
+    return [(min(1., search_args['min_frac'] * search_args['eta'] ** rung),
+             min(search_args['max_epochs'], search_args['min_epochs'] * search_args['eta'] ** rung))
+            for rung in range(search_args['rungs'])]
+
+
+def sample_configs(search_args):
+    if search_args['from_log']:
+        hparams = pd.read_csv(os.path.join(MAIN_DIR, 'hparams_log.csv'))
+        hparams = hparams[list(SEARCH_SPACE)].drop_duplicates()
+        return hparams.head(search_args['num_configs']).to_dict('records')
+    rng = np.random.default_rng(seed=search_args['seed'])
+    return [{key: values[rng.integers(len(values))] for key, (flag, values) in SEARCH_SPACE.items()}
+            for _ in range(search_args['num_configs'])]
+
+
+def run_trial(config, trial_id, dataset_frac, epochs, main_args):
+    cmd = [sys.executable, os.path.join(MAIN_DIR, 'main.py'), '-id', trial_id, '-frac', str(dataset_frac),
+           '-e', str(epochs), '-es', str(epochs), '-noeval'] + main_args
+    for key, value in config.items():
+        cmd += [SEARCH_SPACE[key][0], str(value)]
+    subprocess.run(cmd, cwd=MAIN_DIR)
+
+
+def trial_score(trial_id, main_args):
+    args = vars(parser().parse_args(main_args + ['-id', trial_id, '-test']))
+    train_logs = Directories(args).dirs['train_logs']
+    if not os.path.isfile(train_logs):  # Trial crashed before the first epoch ended
+        return np.nan
+    logs = pd.read_csv(train_logs)
+    return logs[MONITOR].max() if MONITOR in logs.columns else np.nan
+
+
+def successive_halving(search_args, main_args):
+    for _, epochs in rung_budgets(search_args):  # Fail before the sweep, e.g. on resizing stages longer than a rung
+        validate_args(vars(parser().parse_args(main_args + ['-e', str(epochs)])))
+    rungs_file = os.path.join(TRIALS_DIR, f"sweep_{search_args['sweep_id']}.csv")
+    os.makedirs(TRIALS_DIR, exist_ok=True)
+    fieldnames = ['sweep_id', 'rung', 'config_id', 'trial_id', 'dataset_frac', 'epochs', MONITOR, 'promoted'] + list(SEARCH_SPACE)
+    with open(rungs_file, 'w') as f:
+        csv.DictWriter(f, fieldnames=fieldnames).writeheader()
+
+    configs = dict(enumerate(sample_configs(search_args)))
+    for rung, (dataset_frac, epochs) in enumerate(rung_budgets(search_args)):
+        print(f"Rung {rung}| Configurations:{len(configs)} Dataset fraction:{dataset_frac} Epochs:{epochs}")
+        results = []
+        for config_id, config in configs.items():
+            trial_id = f"{search_args['sweep_id']}_r{rung}_c{config_id}"
+            run_trial(config, trial_id, dataset_frac, epochs, main_args)
+            results.append({'sweep_id': search_args['sweep_id'], 'rung': rung, 'config_id': config_id,
+                            'trial_id': trial_id, 'dataset_frac': dataset_frac, 'epochs': epochs,
+                            MONITOR: trial_score(trial_id, main_args), **config})
+        num_promoted = max(1, len(results) // search_args['eta'])
+        # NaN scores (crashed trials) sort last and are never promoted over a finished trial.
+        ranked = sorted(results, key=lambda result: -np.nan_to_num(result[MONITOR], nan=-np.inf))
+        promoted = {result['config_id'] for result in ranked[:num_promoted]}
+        with open(rungs_file, 'a') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            for result in results:
+                writer.writerow({**result, 'promoted': result['config_id'] in promoted})
+        configs = {config_id: configs[config_id] for config_id in promoted}
+    print(f"Rungs written to {rungs_file}")
+    return configs
+
+
+if __name__ == '__main__':
+    # Unknown arguments are forwarded to every main.py trial, e.g. -task nev_mel -it clinic -pt effnet0
+    known_args, forwarded_args = search_parser().parse_known_args()
+    successive_halving(vars(known_args), forwarded_args)
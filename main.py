@@ -1,18 +1,32 @@
 import os
+import sys
+import json
 from contextlib import redirect_stdout
+from settings import parser, Directories, log_params, cpu_threading, validate_args
+
+args = vars(parser().parse_args())
+validate_args(args)
+if args['check_args']:
+    print(json.dumps(args, indent=4))
+    sys.exit()
+if args['strategy'] == 'cpu':
+    cpu_threading(args)  # Before importing TensorFlow, which reads the oneDNN settings on import
 import tensorflow as tf
 import tensorflow_addons as tfa
+from custom_callbacks import EnrTensorboard, StagedEarlyStopping, ResumableCheckpoint, StepTimeProfiler, MemoryTracker, \
+    HardExampleMining, FullValidation
 from custom_losses import categorical_focal_loss, losses
-from custom_metrics import GeometricMean, calc_metrics
-from data_prep import get_train_dataset, get_val_test_dataset, get_isic20_test_dataset
+from custom_metrics import GeometricMean, calc_metrics, threshold_metrics, STREAMING_METRICS
+from data_prep import get_train_dataset, get_val_test_dataset, get_isic20_test_dataset, teacher_predictions, \
+    start_data_service
 from features_def import TASK_CLASSES
-from models_init import model_struct
-from settings import parser, Directories, log_params
+from models_init import model_struct, Distiller, GradientAccumulation, SampleLossTracker, GeMPooling2D, AttentionPooling2D
+from tools.tf_config import cluster_resolver, set_tf_config
 
 # from prepare_images import setup_images
 
-args = vars(parser().parse_args())
-os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(map(str, (range(args['gpus']))))
+if args['strategy'] != 'cpu':
+    os.environ['CUDA_VISIBLE_DEVICES'] = ','.join(map(str, (range(args['gpus']))))
 os.environ['TF_GPU_THREAD_MODE'] = 'gpu_private'
 for gpu in tf.config.experimental.list_physical_devices('GPU'):
     tf.config.experimental.set_memory_growth(gpu, True)
@@ -23,32 +37,66 @@ if args['os'] == 'linux':
     os.environ['TF_XLA_FLAGS'] = f'--tf_xla_auto_jit=2 --tf_xla_enable_xla_devices --tf_xla_cpu_global_jit'
     # From https://github.com/tensorflow/tensorflow/issues/44176#issuecomment-783768033
     # LD_PRELOAD=/usr/lib/x86_64-linux-gnu/libtcmalloc_minimal.so.4 python main.py args
-dirs = Directories(args).dirs
-# setup_images(args, dirs)
 if args['os'] == 'win32':
     cross_device_ops = tf.distribute.HierarchicalCopyAllReduce()
 else:
     cross_device_ops = tf.distribute.NcclAllReduce()
-if args['strategy'] == 'mirrored':
+chief = True
+if args['strategy'] == 'multiworker':
+    resolver = cluster_resolver(args)
+    set_tf_config(resolver)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.NCCL if args['gpus']
+        else tf.distribute.experimental.CommunicationImplementation.RING))
+    args['num_workers'] = resolver.cluster_spec().num_tasks('worker')
+    args['worker_index'] = resolver.task_id
+    chief = args['worker_index'] == 0
+    # From here on gpus counts the replicas of all workers, which scale the global batch size and the learning rate.
+    args['gpus'] = strategy.num_replicas_in_sync
+elif args['strategy'] == 'cpu':
+    tf.config.threading.set_intra_op_parallelism_threads(args['intra_op_threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(args['inter_op_threads'])
+    strategy = tf.distribute.OneDeviceStrategy('/cpu:0')
+    args['gpus'] = 1  # One CPU replica, for the batch size and learning rate scaling
+elif args['strategy'] == 'mirrored':
     strategy = tf.distribute.MirroredStrategy(cross_device_ops=cross_device_ops)
 else:
     strategy = tf.distribute.OneDeviceStrategy('GPU')
 assert args['gpus'] == strategy.num_replicas_in_sync
+if args['precision'] != 'float32':
+    tf.keras.mixed_precision.set_global_policy(args['precision'])
+dirs = Directories(args, chief=chief).dirs
+# setup_images(args, dirs)
+
 
+custom_objects = {'categorical_focal_loss_fixed': categorical_focal_loss(), 'GeometricMean': GeometricMean,
+                  'GeMPooling2D': GeMPooling2D, 'AttentionPooling2D': AttentionPooling2D, **STREAMING_METRICS}
 
 if not args['test']:
-    log_params(args, dirs)
+    args['effective_batch_size'] = args['batch_size'] * args['gpus'] * args['accumulate_steps']
+    if chief and not args['resume']:
+        log_params(args, dirs)
+    rng = tf.random.Generator.from_non_deterministic_state()  # Augmentations, checkpointed with the model
+    if args['data_service'] == 'local':
+        args['data_service'], data_servers = start_data_service(num_workers=args['data_service_workers'])
     optimizer = {'adam': tf.keras.optimizers.Adam, 'adamax': tf.keras.optimizers.Adamax,
                  'nadam': tf.keras.optimizers.Nadam, 'ftrl': tf.keras.optimizers.Ftrl,
                  'rmsprop': tf.keras.optimizers.RMSprop, 'sgd': tf.keras.optimizers.SGD,
                  'adagrad': tf.keras.optimizers.Adagrad, 'adadelta': tf.keras.optimizers.Adadelta
                  }[args['optimizer']]
-    loss = losses(args)[args['loss_fn']]
+    if args['multi_task']:
+        loss = {f'class_{task}': losses(args, num_classes=len(class_names))[args['loss_fn']]
+                for task, class_names in TASK_CLASSES.items()}
+        # Heads named after tasks, e.g. val_class_ben_mal_geometric_mean. 5cls has no binary g-mean.
+        monitor = 'val_class_5cls_f1' if args['task'] == '5cls' else f"val_class_{args['task']}_{args['monitor']}"
+    else:
+        loss = losses(args, num_classes=len(TASK_CLASSES[args['task']]))[args['loss_fn']]
+        monitor = f"val_{args['monitor']}"
     with strategy.scope():
-        if args['load_model']:
-            model = tf.keras.models.load_model(dirs['load_path'], compile=True,
-                                               custom_objects={'categorical_focal_loss_fixed': categorical_focal_loss(),
-                                                               'GeometricMean': GeometricMean})
+        if args['load_model'] and not args['distill']:
+            # Compiled below with new metrics and optimizer, which also loads 5cls models saved without the
+            # num_classes of GeometricMean
+            model = tf.keras.models.load_model(dirs['load_path'], compile=False, custom_objects=custom_objects)
         else:
             model = model_struct(args=args)
         if args['fine']:
@@ -59,42 +107,113 @@ if not args['test']:
             for layer in model.layers:
                 if layer.name.startswith(('efficient', 'inception', 'xception')):
                     layer.trainable = False
+        teacher_pred = None
+        if args['distill']:  # --load-model is the teacher, the student is the new model_struct above
+            teacher = tf.keras.models.load_model(dirs['load_path'], compile=False, custom_objects=custom_objects)
+            teacher.trainable = False
+            if args['cache_teacher']:
+                teacher_pred = teacher_predictions(args=args, dirs=dirs, teacher=teacher)
+                teacher = None
+            model = Distiller(student=model, teacher=teacher, alpha=args['distill_alpha'], temperature=args['temperature'])
+        if args['accumulate_steps'] > 1:
+            model = GradientAccumulation(model=model, steps=args['accumulate_steps'])
+        if args['hard_mining']:
+            model = SampleLossTracker(model=model, loss=loss)
 
-        model.compile(loss=loss, optimizer=optimizer(learning_rate=args['learning_rate'] * args['gpus']),
-                      metrics=[tfa.metrics.F1Score(num_classes=len(TASK_CLASSES[args['task']]), average='macro', name='f1'),
-                               GeometricMean()])
+        if args['multi_task']:
+            metrics = {f'class_{task}': [tfa.metrics.F1Score(num_classes=len(class_names), average='macro', name='f1')] +
+                       ([GeometricMean(num_classes=len(class_names))] + threshold_metrics(args) if len(class_names) == 2 else [])
+                       for task, class_names in TASK_CLASSES.items()}
+        else:
+            metrics = [tfa.metrics.F1Score(num_classes=len(TASK_CLASSES[args['task']]), average='macro', name='f1'),
+                       GeometricMean(num_classes=len(TASK_CLASSES[args['task']]))] + (threshold_metrics(args) if args['task'] != '5cls' else [])
+        optimizer = optimizer(learning_rate=args['learning_rate'] * args['gpus'] * args['accumulate_steps'])
+        if args['precision'] == 'mixed_float16':  # bfloat16 has the range of float32 and needs no loss scaling
+            optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        model.compile(loss=loss, optimizer=optimizer, metrics=metrics)
 
         with redirect_stdout(open(dirs['model_summary'], 'w', encoding='utf-8')):
-            model.summary()  # show_trainable=True)
+            (model.student if args['distill'] else model.network if args['accumulate_steps'] > 1 or args['hard_mining']
+             else model).summary()  # show_trainable=True)
 
-        model.fit(x=get_train_dataset(args=args, dirs=dirs), epochs=args['epochs'],
-                  validation_data=get_val_test_dataset(args=args, dataset='validation', dirs=dirs),
-                  callbacks=[tf.keras.callbacks.CSVLogger(filename=dirs['train_logs'], separator=',', append=True),
-                             tf.keras.callbacks.EarlyStopping(monitor='val_geometric_mean', mode='max', verbose=1,
-                                                              patience=args['early_stop'], restore_best_weights=True),
-                             # EnrTensorboard(val_data=validation_data, log_dir=dirs['logs'], class_names=TASK_CLASSES[args['task']]),
-                             ]
-                  )
+        early_stopping = StagedEarlyStopping(monitor=monitor, mode='max', verbose=1, patience=args['early_stop'],
+                                             restore_best_weights=True)
+        tensorboard = EnrTensorboard(log_dir=dirs['logs'], profile_batch=0, write_graph=False,
+                                     class_names={f'class_{task}': class_names for task, class_names in TASK_CLASSES.items()}
+                                     if args['multi_task'] else TASK_CLASSES[args['task']])
+        profiling = []  # Before CSVLogger, so that the epoch means of the step statistics are logged
+        if args['step_stats'] or args['profile_window']:
+            profiling.append(StepTimeProfiler(save_dir=dirs['trial'], global_batch_size=args['effective_batch_size'],
+                                              profile_window=args['profile_window'], log_dir=dirs['logs']))
+        if args['memory_log']:
+            profiling.append(MemoryTracker(save_dir=dirs['trial']))
+        mining = [HardExampleMining(floor=args['hard_mining_floor'], every=args['hard_mining_every'])] \
+            if args['hard_mining'] else []
+        full_validation = [FullValidation(validation_data=get_val_test_dataset(args=args, dataset='validation', dirs=dirs),
+                                          every=args['full_val_every'], last_epoch=args['epochs'],
+                                          save_dir=dirs['trial'])] \
+            if args['val_subset'] < 1. else []
+        checkpointing = []
+        if args['checkpoint_every']:
+            checkpointing.append(ResumableCheckpoint(directory=dirs['checkpoints'], early_stopping=early_stopping, rng=rng,
+                                                     every=args['checkpoint_every'], max_to_keep=args['keep_checkpoints']))
+        initial_epoch = checkpointing[0].restore(model, directory=dirs['resume_checkpoints']) if args['resume'] else 0
+        # Progressive resizing stages at reduced image size, then the rest of the epochs at --image-size
+        stages = [(image_size, args['stage_epochs']) for image_size in args['progressive_resize']]
+        stages.append((args['image_size'], args['epochs'] - sum(epochs for _, epochs in stages)))
+        stage_end = 0
+        for image_size, epochs in stages:
+            stage_end += epochs
+            if stage_end <= initial_epoch:  # Stage finished before the resumed checkpoint
+                continue
+            model.fit(x=get_train_dataset(args=args, dirs=dirs, teacher_pred=teacher_pred, image_size=image_size, rng=rng,
+                                          mining=mining[0] if mining else None),
+                      initial_epoch=initial_epoch, epochs=stage_end,
+                      validation_data=get_val_test_dataset(args=args, dataset='validation', dirs=dirs,
+                                                           subset=args['val_subset']),
+                      callbacks=profiling + mining + full_validation +
+                      [tensorboard,  # Before CSVLogger, which then logs the learning rate
+                       tf.keras.callbacks.CSVLogger(filename=dirs['train_logs'], separator=',', append=True),
+                       early_stopping] + checkpointing
+                      )
+            initial_epoch = stage_end
+            if model.stop_training:
+                break
+        if full_validation:  # The saved model: the best weights if early stopping restored them, else the last epoch
+            full_validation[0].evaluate_final(epoch=early_stopping.best_epoch if model.stop_training else args['epochs'] - 1)
+    if args['distill']:
+        model = model.student
+    elif args['accumulate_steps'] > 1 or args['hard_mining']:
+        model = model.network
     model.save(filepath=dirs['save_path'])
-args['clinic_val'] = False
-for image_type in ('clinic', 'derm'):
-    args['image_type'] = image_type
-    thr_d, thr_f1 = calc_metrics(args=args, dirs=dirs, model=model,
-                                 dataset=get_val_test_dataset(args=args, dataset='validation', dirs=dirs),
-                                 dataset_name='validation')
-    test_datasets = {'derm': ['isic16_test', 'isic17_test', 'isic18_val_test',
-                              'mclass_derm_test', 'up_test'],
-                     'clinic': ['up_test', 'dermofit_test', 'mclass_clinic_test']}
-    if args['task'] == 'nev_mel':
-        test_datasets['derm'].remove('isic16_test')
+    if args['strategy'] == 'multiworker':
+        if not chief:
+            exit()
+        # Evaluate on the chief alone, on the full datasets, with the saved model out of the collective strategy
+        args['num_workers'] = 1
+        model = tf.keras.models.load_model(dirs['save_path'], compile=False, custom_objects=custom_objects)
+if args['test']:  # Inference with the model given by --load-model, e.g. on CPU-only evaluation hosts
+    model = tf.keras.models.load_model(dirs['load_path'], compile=False, custom_objects=custom_objects)
+if not args['no_eval']:
+    args['clinic_val'] = False
+    for image_type in ('clinic', 'derm'):
+        args['image_type'] = image_type
+        thr_d, thr_f1 = calc_metrics(args=args, dirs=dirs, model=model,
+                                     dataset=get_val_test_dataset(args=args, dataset='validation', dirs=dirs),
+                                     dataset_name='validation')
+        test_datasets = {'derm': ['isic16_test', 'isic17_test', 'isic18_val_test',
+                                  'mclass_derm_test', 'up_test'],
+                         'clinic': ['up_test', 'dermofit_test', 'mclass_clinic_test']}
+        if args['task'] == 'nev_mel' and not args['multi_task']:
+            test_datasets['derm'].remove('isic16_test')
 
-    for test_dataset in test_datasets[args['image_type']]:
-        calc_metrics(args=args, dirs=dirs, model=model,
-                     dataset=get_val_test_dataset(args=args, dataset=test_dataset, dirs=dirs),
-                     dataset_name=test_dataset, dist_thresh=thr_d, f1_thresh=thr_f1)
-    if args['task'] == 'ben_mal' and args['image_type'] == 'derm':
-        calc_metrics(args=args, dirs=dirs, model=model,
-                     dataset=get_isic20_test_dataset(args=args, dirs=dirs),
-                     dataset_name='isic20_test', dist_thresh=thr_d, f1_thresh=thr_f1)
+        for test_dataset in test_datasets[args['image_type']]:
+            calc_metrics(args=args, dirs=dirs, model=model,
+                         dataset=get_val_test_dataset(args=args, dataset=test_dataset, dirs=dirs),
+                         dataset_name=test_dataset, dist_thresh=thr_d, f1_thresh=thr_f1)
+        if (args['task'] == 'ben_mal' or args['multi_task']) and args['image_type'] == 'derm':
+            calc_metrics(args=args, dirs=dirs, model=model,
+                         dataset=get_isic20_test_dataset(args=args, dirs=dirs),
+                         dataset_name='isic20_test', dist_thresh=thr_d, f1_thresh=thr_f1)
 
 exit()
@@ -1,9 +1,164 @@
 import numpy as np
 import tensorflow as tf
-from tensorflow.keras.layers import AveragePooling2D, Conv2D, Concatenate, Flatten, Input, Dense, LayerNormalization, Dropout
+from tensorflow.keras.layers import AveragePooling2D, Conv2D, Concatenate, Flatten, GlobalAveragePooling2D, Input, Dense, LayerNormalization, Dropout
 from tensorflow.keras.activations import swish, relu
 from tensorflow.keras.applications import xception, inception_v3, efficientnet
 from features_def import TASK_CLASSES
+from custom_losses import distillation_loss
+
+
+class GeMPooling2D(tf.keras.layers.Layer):
+    """Generalized mean pooling with a trainable exponent. p=1 is average pooling and p->inf max pooling."""
+
+    def __init__(self, p=3., epsilon=1e-6, **kwargs):
+        super().__init__(**kwargs)
+        self.init_p = p
+        self.epsilon = epsilon
+
+    def build(self, input_shape):
+        self.p = self.add_weight(name='p', shape=(), initializer=tf.keras.initializers.Constant(self.init_p), trainable=True)
+        super().build(input_shape)
+
+    def call(self, inputs):
+        # In float32 under mixed precision, as the powers overflow float16
+        p = tf.cast(self.p, tf.float32)
+        pooled = tf.reduce_mean(tf.pow(tf.maximum(tf.cast(inputs, tf.float32), self.epsilon), p), axis=[1, 2])
+        return tf.cast(tf.pow(pooled, 1. / p), inputs.dtype)
+
+    def get_config(self):
+        return {**super().get_config(), 'p': self.init_p, 'epsilon': self.epsilon}
+
+
+class AttentionPooling2D(tf.keras.layers.Layer):
+    """Weighted sum over spatial locations, with weights from a softmax over a learned per-location score."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.score = Dense(1)
+
+    def call(self, inputs):
+        scores = self.score(inputs)  # (batch, height, width, 1)
+        weights = tf.reshape(tf.nn.softmax(tf.reshape(scores, (tf.shape(scores)[0], -1)), axis=-1), tf.shape(scores))
+        return tf.reduce_sum(inputs * weights, axis=[1, 2])
+
+
+class Distiller(tf.keras.Model):
+    """
+    Trains `student` on the compiled loss blended with a soft-target loss against the teacher's predictions.
+    Teacher predictions are read from the cached `teacher_pred` input when present, otherwise the teacher is run on
+    every training batch. Validation and inference use the student only.
+    """
+
+    def __init__(self, student, teacher=None, alpha=0.5, temperature=4., **kwargs):
+        super().__init__(**kwargs)
+        self.student = student
+        self.teacher = teacher
+        self.alpha = alpha
+        self.soft_target_loss = distillation_loss(temperature=temperature)
+        self.soft_target_tracker = tf.keras.metrics.Mean(name='distillation_loss')
+
+    @property
+    def metrics(self):
+        return super().metrics + [self.soft_target_tracker]
+
+    def call(self, inputs, training=None):
+        return {self.student.output_names[0]: self.student(inputs, training=training)}
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        if 'teacher_pred' in x:
+            teacher_pred = x['teacher_pred']
+        else:
+            teacher_pred = self.teacher(x, training=False)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            hard_loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+            soft_loss = tf.nn.compute_average_loss(self.soft_target_loss(teacher_pred, y_pred[self.student.output_names[0]]),
+                                                   sample_weight=sample_weight)
+            loss = (1. - self.alpha) * hard_loss + self.alpha * soft_loss
+        self.optimizer.minimize(loss, self.student.trainable_variables, tape=tape)  # Loss scaled under mixed_float16
+        self.compiled_metrics.update_state(y, y_pred, sample_weight)
+        self.soft_target_tracker.update_state(soft_loss)
+        return {metric.name: metric.result() for metric in self.metrics}
+
+
+class GradientAccumulation(tf.keras.Model):
+    """
+    Trains `model` on batches of `steps` micro-batches, with one optimizer update per batch. The gradients of the
+    micro-batches are summed weighted by their share of the batch, so only the activations of one micro-batch are
+    held at a time. Metrics are updated on every micro-batch. Validation and inference use `model` as is.
+    """
+
+    def __init__(self, model, steps=1, **kwargs):
+        super().__init__(**kwargs)
+        self.network = model
+        self.steps = steps
+
+    def call(self, inputs, training=None):
+        return dict(zip(self.network.output_names, tf.nest.flatten(self.network(inputs, training=training))))
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        batch_size = tf.shape(x['image'])[0]
+        micro_batches = tf.minimum(self.steps, batch_size)  # Never empty, sizes differ by at most one sample
+
+        def micro_step(step, gradients):
+            start, end = step * batch_size // micro_batches, (step + 1) * batch_size // micro_batches
+            x_step, y_step, sample_weight_step = tf.nest.map_structure(
+                lambda tensor: None if tensor is None else tensor[start:end], (x, y, sample_weight))
+            with tf.GradientTape() as tape:
+                y_pred = self(x_step, training=True)
+                loss = self.compiled_loss(y_step, y_pred, sample_weight_step, regularization_losses=self.losses)
+                if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                    loss = self.optimizer.get_scaled_loss(loss)
+            share = tf.cast(end - start, tf.float32) / tf.cast(batch_size, tf.float32)
+            gradients = [accumulated + tf.cast(share, accumulated.dtype) * tf.convert_to_tensor(gradient)
+                         if gradient is not None else accumulated
+                         for accumulated, gradient in zip(gradients, tape.gradient(loss, self.trainable_variables))]
+            self.compiled_metrics.update_state(y_step, y_pred, sample_weight_step)
+            return step + 1, gradients
+
+        # train_step is not converted by AutoGraph when called by fit, hence the explicit while loop
+        _, gradients = tf.while_loop(lambda step, _: step < micro_batches, micro_step,
+                                     (tf.constant(0), [tf.zeros_like(variable) for variable in self.trainable_variables]))
+        if isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+        return {metric.name: metric.result() for metric in self.metrics}
+
+
+class SampleLossTracker(tf.keras.Model):
+    """
+    Trains `model` as compiled and keeps the latest loss of every training sample by image path in `sample_loss`, for
+    hard example mining. `loss` is the compiled loss, per head for multi-task, where the loss of a sample is the sum over
+    the heads it has a label for. Sample weights are left out, they do not make a sample harder.
+    """
+
+    def __init__(self, model, loss, **kwargs):
+        super().__init__(**kwargs)
+        self.network = model
+        self.loss_fns = loss if isinstance(loss, dict) else {name: loss for name in model.output_names}
+        self.sample_loss = tf.lookup.experimental.MutableHashTable(key_dtype=tf.string, value_dtype=tf.float32,
+                                                                   default_value=-1.)
+
+    def call(self, inputs, training=None):
+        return dict(zip(self.network.output_names, tf.nest.flatten(self.network(inputs, training=training))))
+
+    def train_step(self, data):
+        x, y, sample_weight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+        self.optimizer.minimize(loss, self.trainable_variables, tape=tape)
+        self.compiled_metrics.update_state(y, y_pred, sample_weight)
+        sample_loss = tf.add_n([tf.keras.losses.get(loss_fn)(y[head], y_pred[head]) *
+                                tf.cast(tf.reduce_sum(y[head], axis=-1) > 0., tf.float32)  # Unlabelled for this head
+                                for head, loss_fn in self.loss_fns.items()])
+        self.sample_loss.insert(tf.reshape(x['image_path'], [-1]), tf.cast(sample_loss, tf.float32))
+        return {metric.name: metric.result() for metric in self.metrics}
+
+
+HEADS = {'flatten': Flatten, 'avg': GlobalAveragePooling2D, 'gem': GeMPooling2D, 'attention': AttentionPooling2D}
 
 
 def model_struct(args):
@@ -16,6 +171,10 @@ def model_struct(args):
     inputs_list = []
     init = tf.keras.initializers.HeNormal()
     input_shape = (args['image_size'], args['image_size'], 3)
+    if args['progressive_resize']:  # Any image size, as long as the head pools away the spatial dimensions
+        if args['head'] == 'flatten':
+            raise ValueError('Progressive resizing needs a pooled head, select one with --head.')
+        input_shape = (None, None, 3)
     # -------------------------------================= Image data =================----------------------------------- #
 
     base_model = {'xept': xception.Xception,
@@ -71,7 +230,7 @@ def model_struct(args):
     inc_c3_2 = Dropout(rate=args['dropout'], seed=seed)(inc_c3_2)
 
     common = Concatenate()([base_model, inc_avrg, inc_c1, inc_c2_1, inc_c2_2, inc_c3_1, inc_c3_2])
-    common = Flatten()(common)
+    common = HEADS[args['head']](name='pooled_head')(common)
 # --------------------------------================ Tabular data =================--------------------------------- #
     if not args['no_clinical_data']:
         shape = (20,)
@@ -91,15 +250,27 @@ def model_struct(args):
         clinical_data_3 = Dropout(rate=args['dropout'], seed=seed)(clinical_data_3)
         common = Concatenate(axis=-1)([common, clinical_data_1, clinical_data_2, clinical_data_3])
     # -------------------------------================== Concat part ==================---------------------------------#
-    # common = GlobalAvgPool2D()(common)
     common = Dense(merge_nodes[0], activation=act, kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init)(common)
     common = LayerNormalization()(common)
     # common = Dropout(rate=args['dropout'], seed=seed)(common)
     common = Dense(merge_nodes[1], activation=act, kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init)(common)
     common = LayerNormalization()(common)
     # common = Dropout(rate=args['dropout'], seed=seed)(common)
-    common = Dense(merge_nodes[2], activation=act, kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init)(common)
+    common = Dense(merge_nodes[2], activation=act, kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init, name='embedding')(common)
     # common = LayerNormalization()(common)
     # common = Dense(16, activation=act, kernel_regularizer=rglzr)(common)
-    output = Dense(len(TASK_CLASSES[args['task']]), activation='softmax', kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init, name='class')(common)
-    return tf.keras.Model(inputs_list, [output])
+    # Softmax outputs in float32 under mixed precision too, for the losses and metrics
+    if args['multi_task']:  # One softmax head per task on the shared backbone
+        outputs = [Dense(len(class_names), activation='softmax', kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init, dtype='float32', name=f'class_{task}')(common)
+                   for task, class_names in TASK_CLASSES.items()]
+    else:
+        outputs = [Dense(len(TASK_CLASSES[args['task']]), activation='softmax', kernel_regularizer=l1_l2, kernel_initializer=init, bias_initializer=init, dtype='float32', name='class')(common)]
+    return tf.keras.Model(inputs_list, outputs)
+
+
+def embedding_model(model):
+    """Sub-model of model_struct with the penultimate merge_nodes[2] features as output, for models saved before the
+    layer was named 'embedding' too."""
+    names = [layer.name for layer in model.layers]
+    features = model.get_layer('embedding').output if 'embedding' in names else model.get_layer(model.output_names[0]).input
+    return tf.keras.Model(model.inputs, features)
@@ -13,20 +13,21 @@ def setup_images(args, dirs):
     print('Done!')
 
 
+def hair_removal(image_to_remove_hair):
+    gray_scale = cv2.cvtColor(image_to_remove_hair, cv2.COLOR_RGB2GRAY)
+    kernel = cv2.getStructuringElement(1, (9, 9))
+    blackhat = cv2.morphologyEx(gray_scale, cv2.MORPH_BLACKHAT, kernel)  # Black hat filter
+    bhg = cv2.GaussianBlur(blackhat, (3, 3), cv2.BORDER_DEFAULT)  # Gaussian filter
+    ret, mask = cv2.threshold(bhg, 10, 255, cv2.THRESH_BINARY)  # Binary thresholding (MASK)
+    return cv2.inpaint(image_to_remove_hair, mask, 6, cv2.INPAINT_NS)  # Replace pixels of the mask
+
+
 def hair_removal_and_resize(image_name, args, dirs):
     def resize_img(image_to_resize, size):
         size_ratio = int(size) / max(np.shape(image_to_resize)[:-1])
         return cv2.resize(src=image_to_resize, dsize=None,
                           fx=size_ratio, fy=size_ratio, interpolation=cv2.INTER_NEAREST_EXACT)
 
-    def hair_removal(image_to_remove_hair):
-        gray_scale = cv2.cvtColor(image_to_remove_hair, cv2.COLOR_RGB2GRAY)
-        kernel = cv2.getStructuringElement(1, (9, 9))
-        blackhat = cv2.morphologyEx(gray_scale, cv2.MORPH_BLACKHAT, kernel)  # Black hat filter
-        bhg = cv2.GaussianBlur(blackhat, (3, 3), cv2.BORDER_DEFAULT)  # Gaussian filter
-        ret, mask = cv2.threshold(bhg, 10, 255, cv2.THRESH_BINARY)  # Binary thresholding (MASK)
-        return cv2.inpaint(image_to_remove_hair, mask, 6, cv2.INPAINT_NS)  # Replace pixels of the mask
-
     if not os.path.isfile(os.path.join(dirs['proc_img_folder'], image_name)):
         image = cv2.imread(os.path.join(dirs['init_img_folder'], image_name))
         image = resize_img(image, 500)  # Resize to 500pxl for faster processing
@@ -2,26 +2,33 @@ import sys
 import os
 import csv
 import argparse
+import json
+import socket
+import tempfile
 from datetime import datetime
 
 MAIN_DIR = os.path.dirname(os.path.abspath(__file__))
-INIT_DATA_DIR = os.path.join(MAIN_DIR, 'data')
+# Folder of the dataset CSVs, original (data/) and processed (proc_{size}/) images. Point it elsewhere, e.g. at the
+# output of tools/synthetic_data.py, to run on another copy of the data.
+DATA_DIR = os.getenv('MEL_CNN_DATA_DIR', MAIN_DIR)
+INIT_DATA_DIR = os.path.join(DATA_DIR, 'data')
 LOGS_DIR = os.path.join(MAIN_DIR, 'logs')
 TRIALS_DIR = os.path.join(MAIN_DIR, 'trials')
 MODELS_DIR = os.path.join(MAIN_DIR, 'models')
 INFO_DIR = os.path.join(MAIN_DIR, 'data_info')
 HPARAMS_FILE = os.path.join(MAIN_DIR, 'hparams_log.csv')
-data_csv = {'train': os.path.join(MAIN_DIR, 'data_train.csv'),
-            'validation': os.path.join(MAIN_DIR, 'data_val.csv'),
-            'test': os.path.join(MAIN_DIR, 'data_test.csv'),
-            'isic16_test': os.path.join(MAIN_DIR, 'isic16_test.csv'),
-            'isic17_test': os.path.join(MAIN_DIR, 'isic17_test.csv'),
-            'isic18_val_test': os.path.join(MAIN_DIR, 'isic18_val_test.csv'),
-            'isic20_test': os.path.join(MAIN_DIR, 'isic20_test.csv'),
-            'dermofit_test': os.path.join(MAIN_DIR, 'dermofit_test.csv'),
-            'up_test': os.path.join(MAIN_DIR, 'up_test.csv'),
-            'mclass_clinic_test': os.path.join(MAIN_DIR, 'mclass_clinic_test.csv'),
-            'mclass_derm_test': os.path.join(MAIN_DIR, 'mclass_derm_test.csv')}
+CPU_THREADS_FILE = os.path.join(MAIN_DIR, 'cpu_threads.json')  # Best thread settings per host, tools/cpu_autotune.py
+data_csv = {'train': os.path.join(DATA_DIR, 'data_train.csv'),
+            'validation': os.path.join(DATA_DIR, 'data_val.csv'),
+            'test': os.path.join(DATA_DIR, 'data_test.csv'),
+            'isic16_test': os.path.join(DATA_DIR, 'isic16_test.csv'),
+            'isic17_test': os.path.join(DATA_DIR, 'isic17_test.csv'),
+            'isic18_val_test': os.path.join(DATA_DIR, 'isic18_val_test.csv'),
+            'isic20_test': os.path.join(DATA_DIR, 'isic20_test.csv'),
+            'dermofit_test': os.path.join(DATA_DIR, 'dermofit_test.csv'),
+            'up_test': os.path.join(DATA_DIR, 'up_test.csv'),
+            'mclass_clinic_test': os.path.join(DATA_DIR, 'mclass_clinic_test.csv'),
+            'mclass_derm_test': os.path.join(DATA_DIR, 'mclass_derm_test.csv')}
 
 
 def parser():
@@ -30,6 +37,8 @@ def parser():
                              help='Select pretrained model.')
     args_parser.add_argument('--task', '-task', type=str, default='ben_mal', choices=['5cls', 'ben_mal', 'nev_mel'],
                              help='Select the type of model.')
+    args_parser.add_argument('--multi-task', '-mt', action='store_true',
+                             help='Train one model with a head per task. --task selects the head monitored for early stopping.')
     args_parser.add_argument('--image-type', '-it', type=str, default='both', choices=['derm', 'clinic', 'both'],
                              help='Select image type to use during training.')
     args_parser.add_argument('--image-size', '-is', type=int, default=224, help='Select image size.')
@@ -43,6 +52,8 @@ def parser():
                              help='Select multiplier for number of nodes in dense layers.')
     args_parser.add_argument('--merge-layers', '-mlrs', type=int, default=512,
                              help='Select multiplier for number of nodes in merge layers.')
+    args_parser.add_argument('--head', '-head', type=str, default='flatten', choices=['flatten', 'avg', 'gem', 'attention'],
+                             help='Select how the inception block output is reduced before the merge layers.')
     args_parser.add_argument('--l1-reg', '-l1', type=float, default=0., help='L1 regularization.')
     args_parser.add_argument('--l2-reg', '-l2', type=float, default=1e-7, help='L2 regularization.')
     args_parser.add_argument('--loss-fn', '-loss', type=str, default='focal',
@@ -52,11 +63,40 @@ def parser():
     args_parser.add_argument('--weighted-samples', '-ws', action='store_true',
                              help='Apply sample weights per image type.')
     args_parser.add_argument('--weighted-loss', '-wl', action='store_true', help='Apply class weights.')
+    args_parser.add_argument('--balanced-sampling', '-bsmp', action='store_true',
+                             help='Draw training samples from (class, image type) streams instead of weighting them.')
+    args_parser.add_argument('--sampling-power', '-spow', type=float, default=0.,
+                             help='Stream proportions follow stream size to this power, 0 for equal and 1 for natural.')
+    args_parser.add_argument('--hard-mining', '-hem', action='store_true',
+                             help='Draw training samples in proportion to their latest loss (online hard example mining).')
+    args_parser.add_argument('--hard-mining-frac', '-hemfr', type=float, default=.5,
+                             help='Fraction of the train set drawn per epoch with hard example mining.')
+    args_parser.add_argument('--hard-mining-floor', '-hemfl', type=float, default=.1,
+                             help='Minimum sampling probability of any sample, as a fraction of the uniform probability.')
+    args_parser.add_argument('--hard-mining-every', '-heme', type=int, default=1,
+                             help='Epochs between rebuilds of the hard example mining probabilities.')
+    args_parser.add_argument('--val-subset', '-vsub', type=float, default=1.,
+                             help='Validate on this fraction of the validation set per class, image type and dataset on '
+                                  'most epochs, logged as val_*. The full set is logged as full_val_*.')
+    args_parser.add_argument('--full-val-every', '-fvale', type=int, default=10,
+                             help='Epochs between validations on the full set with --val-subset, also run at the last epoch.')
+    args_parser.add_argument('--steps-per-epoch', '-spe', type=int, default=0,
+                             help='Epoch length of balanced sampling in steps. 0 for as many samples as the train set.')
     args_parser.add_argument('--dataset-frac', '-frac', type=float, default=1., help='Dataset fraction.')
+    args_parser.add_argument('--from-originals', '-orig', action='store_true',
+                             help='Decode, resize and pad the original images of data/ in the input pipeline instead of reading proc_{size}.')
+    args_parser.add_argument('--hair-removal', '-hair', action='store_true', help='Remove hair from the original images of --from-originals.')
+    args_parser.add_argument('--num-parallel-calls', '-npc', type=int, default=0,
+                             help='Parallel calls of the input pipeline maps and batches. 0 for tf.data autotune.')
+    args_parser.add_argument('--prefetch', '-pf', type=int, default=0,
+                             help='Batches prefetched by the input pipeline. 0 for tf.data autotune.')
     args_parser.add_argument('--pretrained', '-pt', type=str, default='effnet6',
                              choices=['incept', 'xept', 'effnet0', 'effnet1', 'effnet6'],
                              help='Select pretrained model.')
     args_parser.add_argument('--batch-size', '-btch', type=int, default=16, help='Select batch size.')
+    args_parser.add_argument('--accumulate-steps', '-accum', type=int, default=1,
+                             help='Split every batch in micro-batches of --batch-size and apply their accumulated gradients '
+                                  'once, for an effective batch size of batch size x gpus x accumulate steps.')
     args_parser.add_argument('--learning-rate', '-lr', type=float, default=1e-5, help='Select learning rate.')
     args_parser.add_argument('--optimizer', '-opt', type=str, default='adamax',
                              choices=['adam', 'ftrl', 'sgd', 'rmsprop', 'adadelta', 'adagrad', 'adamax', 'nadam'],
@@ -65,19 +105,97 @@ def parser():
                              help='Select leaky relu gradient.')
     args_parser.add_argument('--dropout', '-dor', type=float, default=0.2, help='Select dropout ratio.')
     args_parser.add_argument('--epochs', '-e', type=int, default=500, help='Number of max training epochs.')
+    args_parser.add_argument('--progressive-resize', '-prs', type=int, nargs='+', default=[],
+                             help='Image sizes of the first training stages, e.g. 128 176. The last stage trains at --image-size.')
+    args_parser.add_argument('--stage-epochs', '-pse', type=int, default=10,
+                             help='Epochs per progressive resizing stage.')
     args_parser.add_argument('--early-stop', '-es', type=int, default=30, help='Number of early stopping epochs.')
     args_parser.add_argument('--test', '-test', action='store_true', help='Test loaded model with isic2020.')
     args_parser.add_argument('--load-model', '-load', type=str, help='Path to load model.')
     args_parser.add_argument('--fine', '-fine', action='store_true', help='Fine tune.')
-    args_parser.add_argument('--strategy', '-strg', type=str, default='mirrored', choices=['mirrored', 'singlegpu'],
-                             help='Select parallelization strategy.')
+    args_parser.add_argument('--distill', '-dist', action='store_true',
+                             help='Train a new model as student of the teacher model given by --load-model.')
+    args_parser.add_argument('--distill-alpha', '-dista', type=float, default=0.5,
+                             help='Weight of the soft-target loss against the task loss when distilling.')
+    args_parser.add_argument('--temperature', '-temp', type=float, default=4., help='Distillation temperature.')
+    args_parser.add_argument('--cache-teacher', '-ctch', action='store_true',
+                             help='Predict with the teacher once per image and cache the predictions next to it.')
+    args_parser.add_argument('--resume', '-resume', action='store_true',
+                             help='Resume the trial given by --trial-id from its latest checkpoint.')
+    args_parser.add_argument('--checkpoint-every', '-ckpte', type=int, default=1,
+                             help='Checkpoint every this many epochs to allow --resume. 0 to disable.')
+    args_parser.add_argument('--keep-checkpoints', '-ckptk', type=int, default=3, help='Number of checkpoints kept.')
+    args_parser.add_argument('--no-eval', '-noeval', action='store_true',
+                             help='Skip evaluation on validation and test datasets after training.')
+    args_parser.add_argument('--step-stats', '-stst', action='store_true',
+                             help='Record step time, input wait and examples/sec per step in the trial folder.')
+    args_parser.add_argument('--profile-window', '-prfw', type=int, nargs=2, metavar=('START', 'STOP'),
+                             help='Capture a tf.profiler trace of the training steps START to STOP into the logs folder.')
+    args_parser.add_argument('--memory-log', '-meml', action='store_true',
+                             help='Log host memory (RSS, Python heap) per epoch in the trial folder.')
+    args_parser.add_argument('--monitor', '-mon', type=str, default='geometric_mean',
+                             choices=['geometric_mean', 'roc_auc', 'average_precision', 'sens_at_spec'],
+                             help='Validation metric of early stopping. The threshold metrics exist for binary tasks only.')
+    args_parser.add_argument('--specificity', '-spec', type=float, default=.9,
+                             help='Target specificity of the sens_at_spec metric.')
+    args_parser.add_argument('--data-service', '-dsvc', type=str,
+                             help='Run the train pipeline on a tf.data service: dispatcher address, e.g. grpc://node:5050, '
+                                  'or "local" for a dispatcher and --data-service-workers workers in this process. '
+                                  'Remote workers need the images at the same paths.')
+    args_parser.add_argument('--data-service-workers', '-dsw', type=int, default=2,
+                             help='Number of tf.data service workers started by "local".')
+    args_parser.add_argument('--precision', '-prec', type=str, default='float32',
+                             choices=['float32', 'mixed_float16', 'mixed_bfloat16'],
+                             help='Keras dtype policy. Outputs and losses stay in float32 under mixed precision.')
+    args_parser.add_argument('--strategy', '-strg', type=str, default='mirrored',
+                             choices=['mirrored', 'singlegpu', 'multiworker', 'cpu'], help='Select parallelization strategy.')
+    args_parser.add_argument('--intra-op-threads', '-intra', type=int, default=0,
+                             help='CPU strategy: threads within an op. 0 for the host autotune result or TF default.')
+    args_parser.add_argument('--inter-op-threads', '-inter', type=int, default=0,
+                             help='CPU strategy: ops run in parallel. 0 for the host autotune result or TF default.')
+    args_parser.add_argument('--data-threads', '-dthr', type=int, default=0,
+                             help='CPU strategy: private tf.data threadpool size. 0 for the host autotune result or shared pool.')
+    args_parser.add_argument('--onednn', '-onednn', type=str, choices=['on', 'off'],
+                             help='CPU strategy: oneDNN optimizations. Host autotune result or TF default if not given.')
+    args_parser.add_argument('--cluster', '-clst', type=str, default='slurm', choices=['slurm', 'local'],
+                             help='Cluster of the multiworker strategy: SLURM job tasks or local processes.')
+    args_parser.add_argument('--num-workers', '-nwrk', type=int, default=1, help='Number of local multiworker processes.')
+    args_parser.add_argument('--worker-index', '-wrki', type=int, default=0, help='Index of this local worker process.')
+    args_parser.add_argument('--base-port', '-port', type=int, default=12345, help='First port of the worker servers.')
+    args_parser.add_argument('--check-args', '-chk', action='store_true',
+                             help='Validate the arguments, print them and exit before importing TensorFlow.')
     args_parser.add_argument('--gpus', '-gpus', type=int, default=2, help='Select number of GPUs.')
     args_parser.add_argument('--os', '-os', type=str, default=sys.platform, help='Operating System.')
     return args_parser
 
 
+def validate_args(args):
+    """Raises ValueError for argument combinations main.py does not support. Needs no TensorFlow, to fail fast."""
+    if args['precision'] == 'mixed_float16' and args['strategy'] == 'cpu':
+        raise ValueError('CPU kernels such as the oneDNN layer normalization lack float16, use mixed_bfloat16 on CPU.')
+    if args['hair_removal'] and not args['from_originals']:
+        raise ValueError('--hair-removal applies to --from-originals, the proc_{size} images are already hair-free.')
+    if args['test']:
+        return
+    if len(args['progressive_resize']) * args['stage_epochs'] >= args['epochs']:
+        raise ValueError(f"--progressive-resize stages take {len(args['progressive_resize']) * args['stage_epochs']} of the "
+                         f"{args['epochs']} --epochs, which leaves no epochs at --image-size.")
+    if args['task'] == '5cls' and not args['multi_task'] and args['monitor'] != 'geometric_mean':
+        raise ValueError(f"--monitor {args['monitor']} is a binary metric, 5cls monitors geometric_mean only.")
+    if args['resume'] and not args['checkpoint_every']:
+        raise ValueError('--resume needs the checkpoints of --checkpoint-every.')
+    if args['distill'] and args['multi_task']:
+        raise ValueError('Distillation trains a single-task student, it does not support --multi-task.')
+    if args['distill'] and args['accumulate_steps'] > 1:
+        raise ValueError('Distillation does not support --accumulate-steps.')
+    if args['hard_mining'] and (args['distill'] or args['accumulate_steps'] > 1 or args['balanced_sampling']
+                                or args['data_service']):
+        raise ValueError('Hard example mining does not support distillation, --accumulate-steps, balanced sampling '
+                         'or tf.data service.')
+
+
 class Directories:
-    def __init__(self, args):
+    def __init__(self, args, chief=True):
         self.trial_id = args['trial_id']
         self.task = args['task']
         self.image_type = args['image_type']
@@ -86,7 +204,12 @@ class Directories:
         self.test = args['test']
         self.image_size = args['image_size']
         self.new_folder = os.path.join(self.task, self.image_type, self.trial_id)
-        self.proc_img_folder = os.path.join(MAIN_DIR, f"proc_{self.image_size}")
+        # Image paths relative to this folder are the same for the original and the processed images
+        self.proc_img_folder = INIT_DATA_DIR if args['from_originals'] else os.path.join(DATA_DIR, f"proc_{self.image_size}")
+        # Workers other than the chief take part in collective saves but write them in a scratch folder.
+        self.roots = (LOGS_DIR, TRIALS_DIR, MODELS_DIR) if chief else \
+            [os.path.join(tempfile.gettempdir(), 'mel-cnn', f"worker_{args['worker_index']}", fold)
+             for fold in ('logs', 'trials', 'models')]
         self.dirs = self._dir_dict()
 
     def _dir_dict(self):
@@ -104,9 +227,9 @@ class Directories:
                              'validation': data_csv['validation'],
                              'test': data_csv['test'],
                              'isic20_test': data_csv['isic20_test'],
-                             'logs': os.path.join(LOGS_DIR, self.new_folder),
-                             'trial': os.path.join(TRIALS_DIR, self.new_folder),
-                             'save_path': os.path.join(MODELS_DIR, self.new_folder),
+                             'logs': os.path.join(self.roots[0], self.new_folder),
+                             'trial': os.path.join(self.roots[1], self.new_folder),
+                             'save_path': os.path.join(self.roots[2], self.new_folder),
                              'load_path': os.path.join(MODELS_DIR, self.new_folder)}
         if os.getenv('SLURMD_NODENAME'):  # Append node name if training on HPC with SLURM.
             for fold in ('logs', 'trial', 'save_path'):
@@ -118,6 +241,10 @@ class Directories:
             directories['trial'] = directories['trial'] + '_fine'
             directories['save_path'] = directories['save_path'] + '_fine'
 
+        # Keyed on the trial only, so that a job requeued on another node resumes from the same folder
+        directories['checkpoints'] = os.path.join(self.roots[2], self.new_folder + ('_fine' if self.fine else ''), 'checkpoints')
+        # Every worker resumes from the chief's checkpoints, so that all of them continue at the same epoch
+        directories['resume_checkpoints'] = os.path.join(MODELS_DIR, self.new_folder + ('_fine' if self.fine else ''), 'checkpoints')
         directories['model_summary'] = os.path.join(directories['trial'], 'model_summary.txt')
         directories['train_logs'] = os.path.join(directories['trial'], 'train_logs.csv')
         directories['proc_img_folder'] = self.proc_img_folder
@@ -130,13 +257,32 @@ class Directories:
 
 
 def log_params(args, dirs):
+    """Appends the trial to the hparams log. Columns of new arguments are added to the header, blank for older trials."""
+    rows, fieldnames = [], list(args.keys())
     if os.path.exists(path=dirs['hparams_log']):
-        aw = 'a'
-    else:
-        aw = 'w'
-    with open(dirs['hparams_log'], aw) as f:
-        fieldnames = args.keys()
+        with open(dirs['hparams_log'], newline='') as f:
+            reader = csv.DictReader(f)
+            rows = list(reader)
+            fieldnames = reader.fieldnames + [key for key in args.keys() if key not in reader.fieldnames]
+    with open(dirs['hparams_log'], 'w', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames, restval='', extrasaction='ignore')
-        if aw == 'w':
-            writer.writeheader()
-        writer.writerows([args])
+        writer.writeheader()
+        writer.writerows(rows + [args])
+
+
+def cpu_threading(args):
+    """
+    Fills the CPU strategy thread settings left at their defaults from the host's autotune result and sets the ones
+    read from the environment, so it has to run before TensorFlow is imported.
+    """
+    if os.path.isfile(CPU_THREADS_FILE):
+        with open(CPU_THREADS_FILE) as f:
+            tuned = json.load(f).get(socket.gethostname(), {})
+        for key, value in tuned.items():
+            if not args[key]:
+                args[key] = value
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    if args['onednn']:
+        os.environ['TF_ENABLE_ONEDNN_OPTS'] = '1' if args['onednn'] == 'on' else '0'
+    if args['intra_op_threads']:
+        os.environ['OMP_NUM_THREADS'] = str(args['intra_op_threads'])  # Builds with OpenMP oneDNN
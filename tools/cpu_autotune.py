@@ -0,0 +1,104 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import subprocess
+from settings import MAIN_DIR, CPU_THREADS_FILE, parser, Directories, cpu_threading
+
+# Benchmarks thread settings of the CPU strategy on the real model and input pipeline, one process per setting since
+# they are fixed once TensorFlow starts, and saves the fastest for this host in cpu_threads.json, which
+# main.py -strg cpu reads for the settings it is not given. Run from the repository root, e.g.
+#   python -m tools.cpu_autotune -pt effnet0 -is 224 -btch 16 -tmode inference
+
+
+def autotune_parser():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    args_parser = argparse.ArgumentParser(description='Autotune the CPU strategy thread settings.', allow_abbrev=False)
+    args_parser.add_argument('--tune-intra', '-tintra', type=int, nargs='+', default=sorted({cpus, max(cpus // 2, 1)}),
+                             help='Intra-op thread counts to try.')
+    args_parser.add_argument('--tune-inter', '-tinter', type=int, nargs='+', default=[1, 2],
+                             help='Inter-op thread counts to try.')
+    args_parser.add_argument('--tune-data', '-tdata', type=int, nargs='+', default=sorted({cpus, max(cpus // 2, 1)}),
+                             help='tf.data private threadpool sizes to try.')
+    args_parser.add_argument('--tune-onednn', '-tonednn', type=str, nargs='+', default=['on', 'off'],
+                             choices=['on', 'off'], help='oneDNN settings to try.')
+    args_parser.add_argument('--tune-mode', '-tmode', type=str, default='train', choices=['train', 'inference'],
+                             help='Benchmark training steps or validation predictions.')
+    args_parser.add_argument('--tune-steps', '-tsteps', type=int, default=20, help='Timed steps per setting.')
+    args_parser.add_argument('--tune-output', '-tout', type=str, default='cpu_autotune.json',
+                             help='Path of the JSON report of all settings.')
+    args_parser.add_argument('--tune-worker', '-tworker', type=str, help=argparse.SUPPRESS)  # One setting, internal
+    return args_parser
+
+
+def measure(args, mode, steps):
+    """Images per second of `steps` training steps or prediction batches after a warm-up, in this process."""
+    cpu_threading(args)
+    import tensorflow as tf
+    from custom_losses import losses
+    from data_prep import get_train_dataset, get_val_test_dataset
+    from features_def import TASK_CLASSES
+    from models_init import model_struct
+    tf.config.threading.set_intra_op_parallelism_threads(args['intra_op_threads'])
+    tf.config.threading.set_inter_op_parallelism_threads(args['inter_op_threads'])
+    dirs = Directories(args).dirs
+    model = model_struct(args=args)
+    if mode == 'train':
+        model.compile(loss=losses(args, num_classes=len(TASK_CLASSES[args['task']]))[args['loss_fn']],
+                      optimizer=tf.keras.optimizers.Adam(learning_rate=args['learning_rate']))
+        ds = get_train_dataset(args=args, dirs=dirs).repeat()
+        model.fit(ds, steps_per_epoch=2, verbose=0)  # Warm-up trace
+        start = time.perf_counter()
+        model.fit(ds, steps_per_epoch=steps, verbose=0)
+        images = steps * args['batch_size']
+    else:
+        ds = get_val_test_dataset(args=args, dataset='validation', dirs=dirs).repeat()
+        model.predict(ds, steps=1, verbose=0)
+        start = time.perf_counter()
+        model.predict(ds, steps=steps, verbose=0)
+        images = steps * 50 * args['batch_size']
+    return images / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    tune_args, main_argv = autotune_parser().parse_known_args()  # The rest are main.py arguments
+    tune_args = vars(tune_args)
+    args = vars(parser().parse_args(main_argv + ['-strg', 'cpu', '-test']))
+    args.update({'gpus': 1, 'multi_task': False})  # One CPU replica, and thread costs do not depend on the heads
+
+    if tune_args['tune_worker']:
+        args.update(json.loads(tune_args['tune_worker']))
+        print(json.dumps({'images_per_sec': measure(args, tune_args['tune_mode'], tune_args['tune_steps'])}))
+        sys.exit()
+
+    results = []
+    for intra, inter, data, onednn in itertools.product(tune_args['tune_intra'], tune_args['tune_inter'],
+                                                        tune_args['tune_data'], tune_args['tune_onednn']):
+        setting = {'intra_op_threads': intra, 'inter_op_threads': inter, 'data_threads': data, 'onednn': onednn}
+        run = subprocess.run([sys.executable, '-m', 'tools.cpu_autotune', '-tworker', json.dumps(setting),
+                              '-tmode', tune_args['tune_mode'], '-tsteps', str(tune_args['tune_steps'])] + main_argv,
+                             cwd=MAIN_DIR, capture_output=True, text=True)
+        try:
+            images_per_sec = json.loads(run.stdout.strip().splitlines()[-1])['images_per_sec']
+        except (IndexError, ValueError, KeyError):
+            print(run.stderr[-2000:])
+            images_per_sec = 0.
+        results.append({**setting, 'images_per_sec': round(images_per_sec, 2)})
+        print('intra:{} inter:{} data:{} oneDNN:{}| {} images/sec'.format(
+            str(intra).rjust(3), str(inter).rjust(3), str(data).rjust(3), onednn.rjust(3), results[-1]['images_per_sec']))
+
+    best = max(results, key=lambda result: result['images_per_sec'])
+    hosts = {}
+    if os.path.isfile(CPU_THREADS_FILE):
+        with open(CPU_THREADS_FILE) as f:
+            hosts = json.load(f)
+    hosts[socket.gethostname()] = {key: best[key] for key in ('intra_op_threads', 'inter_op_threads', 'data_threads', 'onednn')}
+    with open(CPU_THREADS_FILE, 'w') as f:
+        json.dump(hosts, f, indent=4)
+    with open(tune_args['tune_output'], 'w') as f:
+        json.dump({'host': socket.gethostname(), 'mode': tune_args['tune_mode'], 'results': results, 'best': best}, f,
+                  indent=4)
+    print(f"Best for {socket.gethostname()}: {hosts[socket.gethostname()]}, saved in {CPU_THREADS_FILE}")
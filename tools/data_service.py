@@ -0,0 +1,30 @@
+import os
+import time
+import argparse
+from data_prep import start_data_service
+
+# Serves the train pipeline of main.py --data-service from spare CPUs or CPU nodes, e.g.
+#   python -m tools.data_service -dport 5050 -workers 8                          # dispatcher and 8 workers
+#   python -m tools.data_service -dispatcher grpc://node01:5050 -workers 16      # 16 more workers on another node
+#   python main.py -dsvc grpc://node01:5050 ...
+# Workers read the images at the paths the training process sees, so other nodes need the same shared filesystem.
+
+
+def service_parser():
+    args_parser = argparse.ArgumentParser(description='Run tf.data service dispatcher and workers.')
+    args_parser.add_argument('--dispatcher-port', '-dport', type=int, default=5050, help='Port of the new dispatcher.')
+    args_parser.add_argument('--dispatcher', '-dispatcher', type=str,
+                             help='Address of a running dispatcher to add workers to, instead of starting one.')
+    args_parser.add_argument('--workers', '-workers', type=int, default=os.cpu_count() // 4 or 1,
+                             help='Number of workers in this process.')
+    return args_parser
+
+
+if __name__ == '__main__':
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    service_args = vars(service_parser().parse_args())
+    address, servers = start_data_service(num_workers=service_args['workers'], port=service_args['dispatcher_port'],
+                                          dispatcher=service_args['dispatcher'])
+    print(f"{service_args['workers']} workers serving {address}. Ctrl-C to stop.")
+    while True:
+        time.sleep(3600)
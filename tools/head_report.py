@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2_as_graph
+from models_init import model_struct, HEADS
+from settings import parser
+
+# Parameters, FLOPs and CPU latency of model_struct for every pooled head variant.
+# Run from the repository root, e.g. python -m tools.head_report -pt effnet0 -is 224 -reps 20
+
+
+def report_parser():
+    args_parser = argparse.ArgumentParser(description='Compare pooled head variants of model_struct.')
+    args_parser.add_argument('--repeats', '-reps', type=int, default=20, help='Timed forward passes per head.')
+    args_parser.add_argument('--timing-batch', '-tbtch', type=int, default=1, help='Batch size of the timed forward passes.')
+    args_parser.add_argument('--report', '-report', type=str, default='head_report.json', help='Path of the JSON report.')
+    return args_parser
+
+
+def count_flops(model, batch):
+    specs = [tf.TensorSpec([batch, *model_input.shape[1:]], model_input.dtype) for model_input in model.inputs]
+    concrete = tf.function(lambda inputs: model(inputs, training=False)).get_concrete_function(specs)
+    frozen, _ = convert_variables_to_constants_v2_as_graph(concrete)
+    options = tf.compat.v1.profiler.ProfileOptionBuilder.float_operation()
+    options['output'] = 'none'
+    return tf.compat.v1.profiler.profile(graph=frozen.graph, run_meta=tf.compat.v1.RunMetadata(), cmd='op',
+                                         options=options).total_float_ops
+
+
+def head_params(model):
+    """Parameters after the backbone, i.e. inception block, pooled head, clinical and merge layers."""
+    return int(sum(layer.count_params() for layer in model.layers
+                   if not layer.name.startswith(('efficient', 'inception_v3', 'xception'))))
+
+
+def cpu_latency(model, batch, repeats):
+    inputs = [tf.random.uniform([batch, *model_input.shape[1:]], maxval=255.) for model_input in model.inputs]
+    model(inputs, training=False)  # Warm-up trace
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model(inputs, training=False)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000.
+
+
+if __name__ == '__main__':
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    model_args, report_args = parser().parse_known_args()
+    model_args, report_args = vars(model_args), vars(report_parser().parse_args(report_args))
+    report = {'pretrained': model_args['pretrained'], 'image_size': model_args['image_size'], 'heads': {}}
+    for head in HEADS:
+        model_args['head'] = head
+        model = model_struct(args=model_args)
+        report['heads'][head] = {'total_params': int(model.count_params()),
+                                 'head_params': head_params(model),
+                                 'flops': int(count_flops(model, report_args['timing_batch'])),
+                                 'cpu_latency_ms': cpu_latency(model, report_args['timing_batch'], report_args['repeats'])}
+        print('{}| Head params:{} FLOPs:{} CPU latency (ms):{}'.format(
+            head.rjust(10), str(report['heads'][head]['head_params']).rjust(12),
+            str(report['heads'][head]['flops']).rjust(14), str(round(report['heads'][head]['cpu_latency_ms'], 2)).rjust(8)))
+        tf.keras.backend.clear_session()
+    with open(report_args['report'], 'w') as f:
+        json.dump(report, f, indent=4)
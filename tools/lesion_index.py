@@ -0,0 +1,187 @@
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from custom_losses import categorical_focal_loss
+from custom_metrics import GeometricMean, STREAMING_METRICS
+from data_prep import get_val_test_dataset
+from models_init import GeMPooling2D, AttentionPooling2D, embedding_model
+from settings import parser, Directories, data_csv
+
+# Similar-lesion retrieval on the penultimate features of a saved model. Embeds every image of the train, validation
+# and test CSVs, indexes the --index-datasets ones in an inverted file (IVF) of spherical k-means cells and queries the
+# rest: each query only scores the vectors of its --probes nearest cells. Reports the latency and the recall@k of the
+# index against exact search. Takes the main.py arguments of the model, e.g.
+#   python -m tools.lesion_index -load models/ben_mal/both/<trial_id> -pt effnet6 -is 224 -rk 10
+#   python -m tools.lesion_index -load models/ben_mal/both/<trial_id> -pt effnet6 -is 224 -rquery isic19/data/ISIC_0000000.jpg
+# The embeddings are cached in --embeddings, delete it after retraining the model.
+
+DATASETS = ('train', 'validation', 'test')
+
+
+def index_parser():
+    args_parser = argparse.ArgumentParser(description='Index the model embeddings for similar-lesion retrieval.')
+    args_parser.add_argument('--embeddings', '-remb', type=str, help='Path of the embeddings npz. Defaults to the model folder.')
+    args_parser.add_argument('--index-datasets', '-ridx', type=str, nargs='+', default=['train'], choices=DATASETS,
+                             help='Datasets in the index. The rest are the queries of the recall report.')
+    args_parser.add_argument('--cells', '-rcells', type=int, default=0, help='IVF cells. 0 for the square root of the indexed images.')
+    args_parser.add_argument('--probes', '-rprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16],
+                             help='Cells scanned per query, one recall report per value.')
+    args_parser.add_argument('--neighbours', '-rk', type=int, default=10, help='Neighbours per query.')
+    args_parser.add_argument('--report-queries', '-rrq', type=int, default=1000, help='Queries of the recall report.')
+    args_parser.add_argument('--query', '-rquery', type=str, nargs='+', default=[],
+                             help='Images of the dataset CSVs to print the neighbours of, relative to the proc_{size} folder.')
+    return args_parser
+
+
+def l2_normalise(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, np.shape(vectors)[-1])
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(scores, k):
+    """Column indices of the `k` highest scores per row, highest first."""
+    k = min(k, scores.shape[1])
+    indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+def spherical_kmeans(vectors, cells, iterations=20, seed=1312, chunk=65536):
+    """Unit centroids of `cells` k-means cells under cosine similarity. Empty cells restart at a random vector."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=cells, replace=False)]
+    for _ in range(iterations):
+        assignment = np.concatenate([np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+                                     for start in range(0, len(vectors), chunk)])
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = np.bincount(assignment, minlength=cells) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(np.sum(empty)), replace=False)]
+        centroids = l2_normalise(sums)
+    return centroids
+
+
+class LesionIndex:
+    """Inverted file index of L2 normalised embeddings with their metadata, e.g. the image path, class, image type and
+    dataset. The vectors are stored sorted by cell, so the candidates of a cell are one contiguous slice."""
+
+    def __init__(self, embeddings, metadata: pd.DataFrame, cells=0, iterations=20, seed=1312):
+        vectors = l2_normalise(embeddings)
+        cells = min(cells or max(int(np.sqrt(len(vectors))), 1), len(vectors))
+        self.centroids = spherical_kmeans(vectors, cells, iterations=iterations, seed=seed)
+        assignment = np.argmax(vectors @ self.centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable')
+        self.vectors = vectors[order]
+        self.metadata = metadata.iloc[order].reset_index(drop=True)
+        self.offsets = np.searchsorted(assignment[order], np.arange(cells + 1))
+
+    def search(self, queries, k=10, probes=8):
+        """(indices, similarities) of the `k` nearest indexed vectors per query, from its `probes` nearest cells.
+        Indices are -1 where the probed cells hold fewer than `k` vectors."""
+        queries = l2_normalise(queries)
+        cells = top_k(queries @ self.centroids.T, probes)
+        indices = np.full((len(queries), k), -1)
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for row, (query, query_cells) in enumerate(zip(queries, cells)):
+            candidates = np.concatenate([np.arange(self.offsets[cell], self.offsets[cell + 1]) for cell in query_cells])
+            scores = self.vectors[candidates] @ query
+            best = top_k(scores[np.newaxis], k)[0]
+            indices[row, :len(best)], similarities[row, :len(best)] = candidates[best], scores[best]
+        return indices, similarities
+
+    def exact_search(self, queries, k=10, chunk=1024):
+        """(indices, similarities) of the `k` nearest indexed vectors per query, scoring every vector."""
+        queries = l2_normalise(queries)
+        indices, similarities = [], []
+        for start in range(0, len(queries), chunk):
+            scores = queries[start:start + chunk] @ self.vectors.T
+            indices.append(top_k(scores, k))
+            similarities.append(np.take_along_axis(scores, indices[-1], axis=1))
+        return np.concatenate(indices), np.concatenate(similarities)
+
+    def neighbours(self, query, k=10, probes=8):
+        """Metadata and similarity of the `k` nearest indexed images to one embedding."""
+        indices, similarities = self.search(query, k=k, probes=probes)
+        found = indices[0] >= 0
+        return self.metadata.iloc[indices[0][found]].assign(similarity=similarities[0][found]).reset_index(drop=True)
+
+
+def extract_embeddings(args, dirs, model, datasets=DATASETS):
+    """L2 normalised embeddings and metadata of every image of `datasets`, in the order of the dataset CSVs."""
+    features = embedding_model(model)
+    embeddings, metadata = [], []
+    for dataset in datasets:
+        image_paths, vectors = [], []
+        for x, *_ in get_val_test_dataset(args, dataset, dirs):
+            image_paths.append(x['image_path'].numpy().reshape(-1))
+            vectors.append(tf.cast(features({key: x[key] for key in features.input_names}, training=False), tf.float32).numpy())
+        images = [os.path.relpath(path.decode(), dirs['proc_img_folder']) for path in np.concatenate(image_paths)]
+        info = pd.read_csv(data_csv[dataset]).drop_duplicates('image').set_index('image')
+        metadata.append(info.loc[images, ['class', 'image_type', 'dataset_id']].reset_index().assign(dataset=dataset))
+        embeddings.append(l2_normalise(np.concatenate(vectors)))
+        print(f"{dataset.rjust(12)}| {len(images)} images embedded")
+    return np.concatenate(embeddings), pd.concat(metadata, ignore_index=True)
+
+
+def recall_report(index, queries, k, probes):
+    """Recall@k of the IVF search against exact search and median milliseconds per single query."""
+    exact, _ = index.exact_search(queries, k=k)
+    start = time.perf_counter()
+    for query in queries:
+        index.exact_search(query, k=k)
+    report = {'exact': {'recall': 1., 'ms_per_query': (time.perf_counter() - start) / len(queries) * 1000.}}
+    for probe in probes:
+        times, found = [], []
+        for query in queries:
+            start = time.perf_counter()
+            indices, _ = index.search(query, k=k, probes=probe)
+            times.append(time.perf_counter() - start)
+            found.append(indices[0])
+        recall = np.mean([len(np.intersect1d(ann[ann >= 0], truth)) / len(truth) for ann, truth in zip(found, exact)])
+        report[f'ivf_{probe}'] = {'recall': float(recall), 'ms_per_query': float(np.median(times)) * 1000.}
+    return report
+
+
+if __name__ == '__main__':
+    main_args, index_args = parser().parse_known_args()
+    args, index_args = vars(main_args), vars(index_parser().parse_args(index_args))
+    args['test'] = True  # Do not create trial folders
+    dirs = Directories(args).dirs
+    embeddings_path = index_args['embeddings'] or os.path.join(dirs['load_path'], 'embeddings.npz')
+    if os.path.isfile(embeddings_path):
+        cached = np.load(embeddings_path, allow_pickle=False)
+        embeddings = cached['embeddings']
+        metadata = pd.DataFrame({column: cached[column] for column in ('image', 'class', 'image_type', 'dataset_id', 'dataset')})
+    else:
+        model = tf.keras.models.load_model(dirs['load_path'], compile=False, custom_objects={
+            'categorical_focal_loss_fixed': categorical_focal_loss(), 'GeometricMean': GeometricMean,
+            'GeMPooling2D': GeMPooling2D, 'AttentionPooling2D': AttentionPooling2D, **STREAMING_METRICS})
+        embeddings, metadata = extract_embeddings(args, dirs, model)
+        np.savez(embeddings_path, embeddings=embeddings, **{column: metadata[column].fillna('').to_numpy(dtype=str)
+                                                            for column in metadata.columns})
+
+    indexed = metadata['dataset'].isin(index_args['index_datasets']).values
+    start = time.perf_counter()
+    index = LesionIndex(embeddings[indexed], metadata[indexed], cells=index_args['cells'])
+    print(f"Indexed {int(np.sum(indexed))} images in {len(index.centroids)} cells in {time.perf_counter() - start:.1f} s")
+
+    queries = np.flatnonzero(~indexed)
+    if len(queries):
+        queries = np.random.default_rng(1312).permutation(queries)[:index_args['report_queries']]
+        report = recall_report(index, embeddings[queries], index_args['neighbours'], index_args['probes'])
+        report = pd.DataFrame(report).T
+        print(f"Recall@{index_args['neighbours']} against exact search over {len(queries)} queries")
+        print(report.round(4).to_string())
+        report.to_csv(os.path.splitext(embeddings_path)[0] + '_recall.csv', index_label='search')
+
+    positions = pd.Series(np.arange(len(metadata)), index=metadata['image']).groupby(level=0).first()
+    for image in index_args['query']:
+        if image not in positions.index:
+            print(f"{image} is not in the dataset CSVs")
+            continue
+        print(f"Neighbours of {image} ({metadata['class'].iloc[positions[image]]}):")
+        print(index.neighbours(embeddings[positions[image]], k=index_args['neighbours'],
+                               probes=max(index_args['probes'])).to_string())
@@ -0,0 +1,18 @@
+import os
+import sys
+import subprocess
+from settings import MAIN_DIR, parser
+
+# Runs main.py as --num-workers local multiworker processes, e.g. to test the multiworker strategy on CPU:
+#   python -m tools.local_workers -nwrk 2 -gpus 0 -pt effnet0 -is 64 -btch 8 -e 2
+# Every argument is forwarded to the workers. Exits with the first non-zero worker exit code.
+
+if __name__ == '__main__':
+    args = vars(parser().parse_args())
+    trial_id = ['-id', args['trial_id']] if '-id' not in sys.argv and '--trial-id' not in sys.argv else []
+    workers = [subprocess.Popen([sys.executable, os.path.join(MAIN_DIR, 'main.py'), '-strg', 'multiworker',
+                                 '-clst', 'local', '-wrki', str(index)] + trial_id + sys.argv[1:], cwd=MAIN_DIR)
+               for index in range(args['num_workers'])]
+    exit_codes = [worker.wait() for worker in workers]
+    print(f"Worker exit codes: {exit_codes}")
+    sys.exit(next((code for code in exit_codes if code), 0))
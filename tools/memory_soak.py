@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from settings import MAIN_DIR, parser, Directories
+
+# Soak benchmark for host memory leaks: trains main.py for several epochs on small synthetic data with --memory-log and
+# fails (exit code 1) if RSS grows by more than --max-growth MiB per epoch after the warm-up epochs.
+# Run from the repository root, e.g. python -m tools.memory_soak -pt effnet0 -is 64 -btch 8 -gpus 1 -strg singlegpu
+
+
+def soak_parser():
+    args_parser = argparse.ArgumentParser(description='Memory growth soak benchmark.', allow_abbrev=False)
+    args_parser.add_argument('--soak-epochs', '-sepochs', type=int, default=10, help='Training epochs.')
+    args_parser.add_argument('--warmup-epochs', '-swarm', type=int, default=2,
+                             help='First epochs left out of the growth fit, while allocators and caches fill up.')
+    args_parser.add_argument('--max-growth', '-mgrowth', type=float, default=20.,
+                             help='Maximum RSS growth per epoch in MiB.')
+    args_parser.add_argument('--soak-data', '-sdata', type=str, default=os.path.join(MAIN_DIR, 'synthetic_soak'),
+                             help='Synthetic data folder, generated with tools.synthetic_data if missing.')
+    args_parser.add_argument('--soak-images', '-simgs', type=int, nargs=3, default=[512, 128, 16],
+                             help='Synthetic train, validation and per test dataset samples.')
+    args_parser.add_argument('--soak-output', '-sout', type=str, default='memory_soak.json',
+                             help='Path of the JSON result.')
+    return args_parser
+
+
+def growth_per_epoch(values, warmup):
+    """Least squares slope over the epochs after the warm-up, robust to the step at the first epochs."""
+    values = np.asarray(values, dtype=float)[warmup:]
+    if len(values) < 2:
+        return np.nan
+    return float(np.polyfit(np.arange(len(values)), values, 1)[0])
+
+
+if __name__ == '__main__':
+    soak_args, main_argv = soak_parser().parse_known_args()  # The rest is forwarded to main.py
+    soak_args = vars(soak_args)
+    train_count, val_count, test_count = soak_args['soak_images']
+    image_size = vars(parser().parse_known_args(main_argv)[0])['image_size']
+    if not os.path.isfile(os.path.join(soak_args['soak_data'], 'data_train.csv')):
+        subprocess.run([sys.executable, '-m', 'tools.synthetic_data', '-out', soak_args['soak_data'], '-is', str(image_size),
+                        '-ntrain', str(train_count), '-nval', str(val_count), '-ntest', str(test_count)],
+                       cwd=MAIN_DIR, check=True)
+
+    trial_id = 'soak_' + datetime.now().strftime('%d%m%y%H%M%S')
+    epochs = str(soak_args['soak_epochs'])
+    subprocess.run([sys.executable, os.path.join(MAIN_DIR, 'main.py'), '-id', trial_id, '-e', epochs, '-es', epochs,
+                    '-meml', '-noeval'] + main_argv,
+                   cwd=MAIN_DIR, env={**os.environ, 'MEL_CNN_DATA_DIR': soak_args['soak_data']}, check=True)
+
+    args = vars(parser().parse_args(main_argv + ['-id', trial_id, '-test']))
+    memory = pd.read_csv(os.path.join(Directories(args).dirs['trial'], 'memory.csv'))
+    result = {'trial_id': trial_id, 'epochs': len(memory), 'max_growth_mb': soak_args['max_growth'],
+              'rss_mb_per_epoch': growth_per_epoch(memory['rss_mb'], soak_args['warmup_epochs']),
+              'python_blocks_per_epoch': growth_per_epoch(memory['python_blocks'], soak_args['warmup_epochs']),
+              'gc_objects_per_epoch': growth_per_epoch(memory['gc_objects'], soak_args['warmup_epochs']),
+              'rss_mb': memory['rss_mb'].round(2).tolist()}
+    # NaN growth, e.g. training stopped during the warm-up or no /proc, fails as well.
+    result['passed'] = bool(result['rss_mb_per_epoch'] <= soak_args['max_growth'])
+    with open(soak_args['soak_output'], 'w') as f:
+        json.dump(result, f, indent=4)
+    print('RSS growth: {:.2f} MiB/epoch| Python blocks: {:.0f}/epoch| gc objects: {:.0f}/epoch| {}'.format(
+        result['rss_mb_per_epoch'], result['python_blocks_per_epoch'], result['gc_objects_per_epoch'],
+        'PASSED' if result['passed'] else f"FAILED (> {soak_args['max_growth']} MiB/epoch)"))
+    sys.exit(0 if result['passed'] else 1)
@@ -0,0 +1,129 @@
+import os
+import argparse
+import cv2
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from settings import DATA_DIR, data_csv
+
+# Finds near-duplicate images across data_train.csv, data_val.csv and every test CSV, e.g. the same lesion shipped by
+# two datasets, which leaks between training and test. 64-bit DCT perceptual hashes of the processed images are cached
+# next to them and only computed for new or changed images. Pairs within --hash-distance bits are found by multi-index
+# hashing: with the hash cut into distance + 1 chunks, two hashes within the distance match exactly on at least one
+# chunk, so only images sharing a chunk value are compared. Run from the repository root, e.g.
+#   python -m tools.near_duplicates -is 224 -hdist 6
+
+
+def duplicates_parser():
+    args_parser = argparse.ArgumentParser(description='Near-duplicate images across the dataset CSVs.')
+    args_parser.add_argument('--image-size', '-is', type=int, default=224, help='Size of the proc_{size} images to hash.')
+    args_parser.add_argument('--hash-distance', '-hdist', type=int, default=6,
+                             help='Largest Hamming distance between the hashes of near duplicates, out of 64 bits.')
+    args_parser.add_argument('--hash-jobs', '-hjobs', type=int, default=os.cpu_count(), help='Parallel hashing jobs.')
+    args_parser.add_argument('--hash-output', '-hout', type=str, default='near_duplicates.csv',
+                             help='Path of the CSV of near-duplicate clusters.')
+    return args_parser
+
+
+def phash(path):
+    """64-bit perceptual hash: signs of the lowest 8x8 DCT frequencies of the 32x32 grey image against their median."""
+    image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    dct = cv2.dct(cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32))[:8, :8].flatten()
+    bits = dct > np.median(dct[1:])  # Median without the DC term, which only carries the brightness
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def image_hashes(images, image_folder, jobs):
+    """Hashes of `images`, from the cache in `image_folder` where the image file is unchanged."""
+    cache_path = os.path.join(image_folder, 'phash.csv')
+    # Integer nanosecond modification times, which survive the CSV round trip exactly unlike float seconds
+    cache = pd.read_csv(cache_path, index_col='image', dtype={'mtime_ns': 'Int64', 'size': 'Int64', 'hash': str}) \
+        if os.path.isfile(cache_path) else pd.DataFrame(index=pd.Index([], name='image'))
+    cache = cache.reindex(columns=['mtime_ns', 'size', 'hash']).astype({'mtime_ns': 'Int64', 'size': 'Int64', 'hash': object})
+    stats = pd.DataFrame([(os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.isfile(path) else (None, None)
+                          for path in (os.path.join(image_folder, image) for image in images)],
+                         index=pd.Index(images, name='image'), columns=['mtime_ns', 'size']).astype('Int64')
+    cached = cache.reindex(stats.index)
+    unchanged = ((cached['mtime_ns'] == stats['mtime_ns']) & (cached['size'] == stats['size'])).fillna(False)
+    stale = stats.index[~unchanged.astype(bool) & stats['size'].notna()]
+    if len(stale):
+        print(f"Hashing {len(stale)} new or changed images...")
+        hashes = Parallel(n_jobs=jobs, batch_size=256)(delayed(phash)(os.path.join(image_folder, image)) for image in stale)
+        cached.loc[stale, ['mtime_ns', 'size']] = stats.loc[stale].values
+        cached.loc[stale, 'hash'] = [None if value is None else f'{value:016x}' for value in hashes]
+        cache = pd.concat([cache.drop(cache.index.intersection(stale)), cached.loc[stale]])
+        cache.to_csv(cache_path, index_label='image')
+    cached = cached.dropna(subset=['hash'])
+    return pd.Series([int(value, 16) for value in cached['hash']], index=cached.index, dtype=np.uint64)
+
+
+def popcount(values):
+    return np.unpackbits(values.astype('>u8').view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def near_pairs(hashes, distance, block=2048):
+    """Index pairs (i < j) of `hashes` within `distance` bits, by multi-index hashing on distance + 1 chunks."""
+    bounds = np.linspace(0, 64, min(distance + 1, 64) + 1).astype(int)
+    pairs = set()
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        chunks = (hashes >> np.uint64(64 - high)) & np.uint64((1 << (high - low)) - 1)
+        for members in pd.Series(np.arange(len(hashes))).groupby(chunks).indices.values():
+            if len(members) < 2:
+                continue
+            for start in range(0, len(members), block):  # Bounded memory for large buckets, e.g. blank images
+                rows = members[start:start + block]
+                xor = hashes[rows][:, np.newaxis] ^ hashes[members][np.newaxis, :]
+                close = popcount(xor.reshape(-1)).reshape(xor.shape) <= distance
+                for i, j in zip(*np.nonzero(close)):
+                    if rows[i] < members[j]:
+                        pairs.add((rows[i], members[j]))
+    return pairs
+
+
+def clusters(size, pairs):
+    """Connected components of the pairs, by union-find. Cluster ID per index, -1 for images without duplicates."""
+    parent = np.arange(size)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in pairs:
+        parent[find(i)] = find(j)
+    roots = np.array([find(i) for i in range(size)])
+    in_pair = np.zeros(size, dtype=bool)
+    in_pair[[index for pair in pairs for index in pair]] = True
+    cluster = np.full(size, -1)
+    cluster[in_pair] = pd.factorize(roots[in_pair])[0]
+    return cluster
+
+
+if __name__ == '__main__':
+    dup_args = vars(duplicates_parser().parse_args())
+    image_folder = os.path.join(DATA_DIR, f"proc_{dup_args['image_size']}")
+    # Every CSV but data_test.csv, the union of the separate test CSVs
+    csvs = {os.path.basename(path).split('.')[0]: path for key, path in data_csv.items() if key != 'test' and os.path.isfile(path)}
+    membership = pd.concat([pd.DataFrame({'image': pd.read_csv(path)['image'], 'csv': name}) for name, path in csvs.items()])
+    membership = membership.groupby('image')['csv'].apply(lambda names: ' '.join(sorted(set(names))))
+
+    hashes = image_hashes(membership.index.tolist(), image_folder, dup_args['hash_jobs'])
+    pairs = near_pairs(hashes.values, dup_args['hash_distance'])
+    cluster = clusters(len(hashes), pairs)
+    shared = (cluster < 0) & membership.loc[hashes.index].str.contains(' ').values  # Same image in several CSVs
+    cluster[shared] = cluster.max() + 1 + np.arange(np.sum(shared))
+    report = pd.DataFrame({'cluster': cluster, 'image': hashes.index, 'csv': membership.loc[hashes.index].values,
+                           'hash': [f'{value:016x}' for value in hashes.values]})
+    report = report[report['cluster'] >= 0].sort_values(['cluster', 'image'])
+    report.to_csv(dup_args['hash_output'], index=False)
+
+    # Clusters spanning more than one CSV, counted per pair of CSVs
+    spans = report.groupby('cluster')['csv'].apply(lambda names: sorted(set(' '.join(names).split())))
+    leaks = pd.Series([f'{first} ~ {second}' for names in spans for i, first in enumerate(names) for second in names[i + 1:]],
+                      dtype=str).value_counts()
+    print(f"{len(hashes)} images| {len(pairs)} near-duplicate pairs| {report['cluster'].nunique()} clusters| "
+          f"{int(np.sum(spans.apply(len) > 1))} across CSVs")
+    for csv_pair, count in leaks.items():
+        print(f"{csv_pair.rjust(45)}| {count} clusters")
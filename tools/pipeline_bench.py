@@ -0,0 +1,131 @@
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import subprocess
+from datetime import datetime
+import tensorflow as tf
+from data_prep import _prep_df_for_tfdataset, _image_reader, _autotune, augm, preprocess, get_train_dataset, \
+    get_val_test_dataset
+from settings import MAIN_DIR, DATA_DIR, INIT_DATA_DIR, parser, Directories
+
+# Drains the input pipelines exactly as main.py builds them, without a model, and reports images/sec.
+# Run from the repository root, e.g. python -m tools.pipeline_bench -pt effnet0 -btch 32 -gpus 1 -bimgs 2048
+# With -borig, also compares decoding proc_{size} against processing the originals of data/ as --from-originals does.
+
+
+def bench_parser():
+    args_parser = argparse.ArgumentParser(description='Benchmark the tf.data input pipelines.')
+    args_parser.add_argument('--bench-images', '-bimgs', type=int, default=2048, help='Images drained per measurement.')
+    args_parser.add_argument('--sweep-parallel-calls', '-snpc', type=int, nargs='+', default=[0, 1, 4, 8, 16],
+                             help='num_parallel_calls values to sweep. 0 for tf.data autotune.')
+    args_parser.add_argument('--sweep-prefetch', '-spf', type=int, nargs='+', default=[0, 1, 4],
+                             help='Prefetch values to sweep. 0 for tf.data autotune.')
+    args_parser.add_argument('--bench-originals', '-borig', action='store_true',
+                             help='Compare decoding proc_{size} against --from-originals with and without hair removal.')
+    args_parser.add_argument('--bench-output', '-bout', type=str, default='pipeline_bench.json',
+                             help='Path of the JSON result.')
+    return args_parser
+
+
+def drain(ds, num_images):
+    """Images per second of `ds`, excluding the first element which includes tracing and file-cache warm-up."""
+    iterator = iter(ds)
+    next(iterator)
+    count, start = 0, time.perf_counter()
+    for element in iterator:
+        images = element[0]['image'] if isinstance(element, tuple) else element
+        count += int(images.shape[0]) if len(images.shape) == 4 else 1
+        if count >= num_images:
+            break
+    elapsed = time.perf_counter() - start
+    return {'images': count, 'seconds': round(elapsed, 4), 'images_per_sec': round(count / elapsed, 2)}
+
+
+def stage_datasets(args, dirs):
+    """Cumulative pipelines of the training input stages: each one adds a stage to the previous."""
+    rng = tf.random.Generator.from_non_deterministic_state()
+    image_path = _prep_df_for_tfdataset(args, 'train', dirs)[0]
+    parallel_calls = _autotune(args, 'num_parallel_calls')
+    batch_size = args['batch_size'] * args['gpus']
+    paths_ds = tf.data.Dataset.from_tensor_slices(image_path).repeat()
+    read_ds = paths_ds.map(tf.io.read_file, num_parallel_calls=parallel_calls, deterministic=True)
+    decode_ds = paths_ds.map(_image_reader(args), num_parallel_calls=parallel_calls, deterministic=True)
+    batch_ds = decode_ds.batch(batch_size, num_parallel_calls=parallel_calls, deterministic=True)
+    return {'read': read_ds.prefetch(_autotune(args, 'prefetch')),
+            'decode': decode_ds.prefetch(_autotune(args, 'prefetch')),
+            'batch': batch_ds.prefetch(_autotune(args, 'prefetch')),
+            'preprocess': batch_ds.map(lambda image: preprocess(image, args), num_parallel_calls=parallel_calls,
+                                       deterministic=True).prefetch(_autotune(args, 'prefetch')),
+            'augment': batch_ds.map(lambda image: augm(image, args, rng), num_parallel_calls=parallel_calls,
+                                    deterministic=True).prefetch(_autotune(args, 'prefetch'))}
+
+
+def source_datasets(args, dirs):
+    """Decoded training images from proc_{size} and from the originals, with and without hair removal."""
+    images = [os.path.relpath(path, dirs['proc_img_folder']) for path in _prep_df_for_tfdataset(args, 'train', dirs)[0]]
+    sources = {'proc': (os.path.join(DATA_DIR, f"proc_{args['image_size']}"), {'from_originals': False}),
+               'originals': (INIT_DATA_DIR, {'from_originals': True, 'hair_removal': False}),
+               'originals_hair': (INIT_DATA_DIR, {'from_originals': True, 'hair_removal': True})}
+    return {source: tf.data.Dataset.from_tensor_slices([os.path.join(folder, image) for image in images]).repeat().map(
+        _image_reader({**args, **source_args}), num_parallel_calls=_autotune(args, 'num_parallel_calls'),
+        deterministic=True).prefetch(_autotune(args, 'prefetch')) for source, (folder, source_args) in sources.items()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=MAIN_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    main_args, bench_args = parser().parse_known_args()
+    args, bench_args = vars(main_args), vars(bench_parser().parse_args(bench_args))
+    args['test'] = True  # Do not create trial folders
+    dirs = Directories(args).dirs
+    result = {'commit': git_commit(), 'host': socket.gethostname(), 'date': datetime.now().isoformat(),
+              'python': sys.version.split()[0], 'tensorflow': tf.__version__,
+              'args': {key: args[key] for key in ('pretrained', 'image_size', 'batch_size', 'gpus', 'image_type', 'task')},
+              'stages': {}, 'sweep': []}
+
+    for stage, ds in stage_datasets(args, dirs).items():
+        result['stages'][stage] = drain(ds, bench_args['bench_images'])
+        print(f"{stage.rjust(12)}| {result['stages'][stage]['images_per_sec']} images/sec")
+    # Per image cost of every stage, from the difference between consecutive cumulative pipelines.
+    previous = 0.
+    for stage in ('read', 'decode', 'batch', 'preprocess'):
+        cost = 1. / result['stages'][stage]['images_per_sec']
+        result['stages'][stage]['ms_per_image'] = round(max(cost - previous, 0.) * 1000., 4)
+        previous = cost
+    decode_cost = 1. / result['stages']['batch']['images_per_sec']
+    result['stages']['augment']['ms_per_image'] = round(
+        max(1. / result['stages']['augment']['images_per_sec'] - decode_cost, 0.) * 1000., 4)
+
+    if bench_args['bench_originals']:
+        result['sources'] = {}
+        for source, ds in source_datasets(args, dirs).items():
+            result['sources'][source] = drain(ds, bench_args['bench_images'])
+            result['sources'][source]['vs_proc'] = round(result['sources'][source]['images_per_sec'] /
+                                                         result['sources']['proc']['images_per_sec'], 3)
+            print(f"{source.rjust(14)}| {result['sources'][source]['images_per_sec']} images/sec| "
+                  f"{result['sources'][source]['vs_proc']}x proc_{args['image_size']}")
+
+    for parallel_calls, prefetch in itertools.product(bench_args['sweep_parallel_calls'], bench_args['sweep_prefetch']):
+        sweep_args = {**args, 'num_parallel_calls': parallel_calls, 'prefetch': prefetch}
+        measurement = {'num_parallel_calls': parallel_calls or 'autotune', 'prefetch': prefetch or 'autotune',
+                       'train': drain(get_train_dataset(args=sweep_args, dirs=dirs).repeat(), bench_args['bench_images']),
+                       'validation': drain(get_val_test_dataset(args=sweep_args, dataset='validation', dirs=dirs).repeat(),
+                                           bench_args['bench_images'])}
+        result['sweep'].append(measurement)
+        print('num_parallel_calls:{} prefetch:{}| train {} images/sec| validation {} images/sec'.format(
+            str(measurement['num_parallel_calls']).rjust(8), str(measurement['prefetch']).rjust(8),
+            measurement['train']['images_per_sec'], measurement['validation']['images_per_sec']))
+
+    with open(bench_args['bench_output'], 'w') as f:
+        json.dump(result, f, indent=4)
+    print(f"Results written to {bench_args['bench_output']}")
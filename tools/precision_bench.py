@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from settings import MAIN_DIR, parser, Directories
+
+# Trains main.py once per --precision with the same arguments and reports median step time, host and device memory
+# and the final validation ROC-AUC against float32. Run from the repository root, e.g.
+#   python -m tools.precision_bench -bprec float32 mixed_float16 -pt effnet6 -is 224 -btch 16 -gpus 1 -strg singlegpu -e 3
+#   python -m tools.precision_bench -bprec float32 mixed_bfloat16 -strg cpu -pt effnet0 -is 64 -btch 8 -e 2
+
+
+def bench_parser():
+    args_parser = argparse.ArgumentParser(description='Compare mixed precision policies.', allow_abbrev=False)
+    args_parser.add_argument('--bench-precisions', '-bprec', type=str, nargs='+',
+                             default=['float32', 'mixed_float16', 'mixed_bfloat16'],
+                             choices=['float32', 'mixed_float16', 'mixed_bfloat16'], help='Policies to compare.')
+    args_parser.add_argument('--warmup-steps', '-bwarm', type=int, default=10,
+                             help='First steps left out of the step time, while tracing and autotuning.')
+    args_parser.add_argument('--auc-tolerance', '-atol', type=float, default=.01,
+                             help='Largest validation ROC-AUC drop against float32 that counts as parity.')
+    args_parser.add_argument('--bench-output', '-bout', type=str, default='precision_bench.json',
+                             help='Path of the JSON result.')
+    return args_parser
+
+
+def trial_report(trial_dir, warmup_steps):
+    steps = pd.read_csv(os.path.join(trial_dir, 'step_times.csv')).iloc[warmup_steps:]
+    memory = pd.read_csv(os.path.join(trial_dir, 'memory.csv'))
+    logs = pd.read_csv(os.path.join(trial_dir, 'train_logs.csv'))
+    report = {'step_time_ms': float(np.median(steps['wall_time'])) * 1000.,
+              'examples_per_sec': float(np.median(steps['examples_per_sec'])),
+              'peak_rss_mb': float(memory['rss_mb'].max()),
+              'val_roc_auc': float(logs['val_roc_auc'].iloc[-1]) if 'val_roc_auc' in logs.columns else np.nan}
+    device_peaks = [column for column in memory.columns if column.endswith('_peak_mb')]
+    if device_peaks:
+        report['peak_device_mb'] = float(memory[device_peaks].max().max())
+    return report
+
+
+if __name__ == '__main__':
+    bench_args, main_argv = bench_parser().parse_known_args()  # The rest is forwarded to main.py
+    bench_args = vars(bench_args)
+    stamp = datetime.now().strftime('%d%m%y%H%M%S')
+    result = {'main_args': main_argv, 'precisions': {}}
+    for precision in bench_args['bench_precisions']:
+        trial_id = f"prec_{precision}_{stamp}"
+        subprocess.run([sys.executable, os.path.join(MAIN_DIR, 'main.py'), '-id', trial_id, '-prec', precision,
+                        '-stst', '-meml', '-noeval'] + main_argv, cwd=MAIN_DIR, check=True)
+        args = vars(parser().parse_args(main_argv + ['-id', trial_id, '-test']))
+        result['precisions'][precision] = trial_report(Directories(args).dirs['trial'], bench_args['warmup_steps'])
+
+    baseline = result['precisions'].get('float32')
+    for precision, report in result['precisions'].items():
+        if baseline and precision != 'float32':
+            report['speedup'] = baseline['step_time_ms'] / report['step_time_ms']
+            report['rss_saving_mb'] = baseline['peak_rss_mb'] - report['peak_rss_mb']
+            if 'peak_device_mb' in report:
+                report['device_saving_mb'] = baseline['peak_device_mb'] - report['peak_device_mb']
+            report['auc_delta'] = report['val_roc_auc'] - baseline['val_roc_auc']
+            report['auc_parity'] = bool(report['auc_delta'] >= -bench_args['auc_tolerance'])
+        print('{}| step {:.1f} ms| {:.1f} examples/sec| peak RSS {:.0f} MiB| val AUC {:.4f}{}'.format(
+            precision.rjust(14), report['step_time_ms'], report['examples_per_sec'], report['peak_rss_mb'],
+            report['val_roc_auc'], f"| speedup x{report['speedup']:.2f} parity {report['auc_parity']}"
+            if 'speedup' in report else ''))
+    with open(bench_args['bench_output'], 'w') as f:
+        json.dump(result, f, indent=4)
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+from settings import MAIN_DIR
+
+# Median wall time of fresh processes for the lightweight commands and the imports of the repository modules, and
+# optionally of loading a saved model outside main.py. Run from the repository root, e.g.
+#   python -m tools.startup_bench -srep 5 -smodel models/ben_mal/both/<trial_id>
+#   python -m tools.startup_bench -simport custom_metrics    # also list the slowest imports of a module
+
+COMMANDS = {'main.py --help': [os.path.join(MAIN_DIR, 'main.py'), '--help'],
+            'main.py --check-args': [os.path.join(MAIN_DIR, 'main.py'), '--check-args'],
+            'import settings': ['-c', 'import settings'],
+            'import numpy': ['-c', 'import numpy'],
+            'import tensorflow': ['-c', 'import tensorflow'],
+            'import custom_metrics': ['-c', 'import custom_metrics'],
+            'import custom_callbacks': ['-c', 'import custom_callbacks'],
+            'import data_prep': ['-c', 'import data_prep'],
+            'import models_init': ['-c', 'import models_init']}
+# Loads with the custom objects of main.py. The extra argument checks that nothing parses this process's argv.
+LOAD_MODEL = ("import sys, tensorflow as tf\n"
+              "from custom_losses import categorical_focal_loss\n"
+              "from custom_metrics import GeometricMean, STREAMING_METRICS\n"
+              "from models_init import GeMPooling2D, AttentionPooling2D\n"
+              "tf.keras.models.load_model(sys.argv[1], compile=True, custom_objects={\n"
+              "    'categorical_focal_loss_fixed': categorical_focal_loss(), 'GeometricMean': GeometricMean,\n"
+              "    'GeMPooling2D': GeMPooling2D, 'AttentionPooling2D': AttentionPooling2D, **STREAMING_METRICS})")
+
+
+def startup_parser():
+    args_parser = argparse.ArgumentParser(description='Benchmark process startup times.')
+    args_parser.add_argument('--startup-repeats', '-srep', type=int, default=5, help='Runs per command.')
+    args_parser.add_argument('--startup-model', '-smodel', type=str, help='Saved model folder to time loading.')
+    args_parser.add_argument('--startup-import', '-simport', type=str,
+                             help='Module to list the 15 slowest imports of, with python -X importtime.')
+    args_parser.add_argument('--startup-output', '-stout', type=str, default='startup_bench.json',
+                             help='Path of the JSON result.')
+    return args_parser
+
+
+def wall_time(command, repeats):
+    """Median seconds of `repeats` fresh interpreters running `command`, which must succeed."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=MAIN_DIR, check=True, capture_output=True)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def slowest_imports(module, count=15):
+    """(cumulative seconds, package) of the slowest imports of `module`, from python -X importtime."""
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=MAIN_DIR, check=True,
+                         capture_output=True, text=True)
+    imports = []
+    for line in run.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, package = line[len('import time:'):].split('|')
+            imports.append((int(cumulative) / 1e6, package.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    startup_args = vars(startup_parser().parse_args())
+    commands = dict(COMMANDS)
+    if startup_args['startup_model']:
+        commands['load model'] = ['-c', LOAD_MODEL, os.path.abspath(startup_args['startup_model']), '--not-a-main-flag']
+    result = {'python': sys.version.split()[0], 'seconds': {}}
+    for name, command in commands.items():
+        result['seconds'][name] = wall_time(command, startup_args['startup_repeats'])
+        print(f"{name.rjust(25)}| {result['seconds'][name]:.2f} s")
+    if startup_args['startup_import']:
+        result['slowest_imports'] = slowest_imports(startup_args['startup_import'])
+        for seconds, package in result['slowest_imports']:
+            print(f"{package.rjust(40)}| {seconds:.2f} s cumulative")
+    with open(startup_args['startup_output'], 'w') as f:
+        json.dump(result, f, indent=4)
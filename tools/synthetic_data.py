@@ -0,0 +1,83 @@
+import os
+import argparse
+import cv2
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from settings import MAIN_DIR, data_csv
+
+# Writes fake dataset CSVs with the schema and the dataset/image type/class distribution of the real ones, plus
+# matching synthetic JPEGs, so that training, evaluation and prepare_images can be profiled without the real images.
+# Run from the repository root, e.g.
+#   python -m tools.synthetic_data -out synthetic -is 224 -ntrain 2000 -nval 500 -ntest 100
+#   MEL_CNN_DATA_DIR=synthetic python main.py -is 224 ...
+
+
+def synthetic_parser():
+    args_parser = argparse.ArgumentParser(description='Generate a synthetic copy of the datasets.')
+    args_parser.add_argument('--output-dir', '-out', type=str, default=os.path.join(MAIN_DIR, 'synthetic'),
+                             help='Folder to use as MEL_CNN_DATA_DIR.')
+    args_parser.add_argument('--image-size', '-is', type=int, default=224, help='Size of the proc_{size} images.')
+    args_parser.add_argument('--train-count', '-ntrain', type=int, default=2000, help='Training samples.')
+    args_parser.add_argument('--val-count', '-nval', type=int, default=500, help='Validation samples.')
+    args_parser.add_argument('--test-count', '-ntest', type=int, default=100, help='Samples per test dataset.')
+    args_parser.add_argument('--originals', '-orig', action='store_true',
+                             help='Also write larger, non square originals in data/ for prepare_images.')
+    args_parser.add_argument('--original-size', '-osize', type=int, nargs=2, default=[1024, 768],
+                             help='Width and height of the originals.')
+    args_parser.add_argument('--jobs', '-jobs', type=int, default=16, help='Parallel image writers.')
+    args_parser.add_argument('--seed', '-seed', type=int, default=1312, help='Seed of the sampling and the images.')
+    return args_parser
+
+
+def synthetic_image(height, width, seed):
+    """Skin coloured background with a dark irregular blob, noise and blur, so JPEG sizes stay realistic."""
+    rng = np.random.default_rng(seed)
+    skin = rng.uniform([120, 140, 180], [190, 200, 240])  # BGR
+    image = np.ones((height, width, 3)) * skin
+    center = (int(width * rng.uniform(0.3, 0.7)), int(height * rng.uniform(0.3, 0.7)))
+    axes = (int(width * rng.uniform(0.1, 0.3)), int(height * rng.uniform(0.1, 0.3)))
+    cv2.ellipse(image, center, axes, rng.uniform(0, 180), 0, 360, (skin * rng.uniform(0.2, 0.6)).tolist(), -1)
+    image += rng.normal(0, 12, size=image.shape)
+    image = cv2.GaussianBlur(np.clip(image, 0, 255).astype(np.uint8), (5, 5), 0)
+    return image
+
+
+def write_image(path, height, width, seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cv2.imwrite(path, synthetic_image(height, width, seed))
+
+
+def synthetic_csvs(synthetic_args):
+    """Rows sampled with replacement from the real CSVs, which keeps their joint distribution, with new image names."""
+    rng = np.random.default_rng(synthetic_args['seed'])
+    counts = {'train': synthetic_args['train_count'], 'validation': synthetic_args['val_count']}
+    dfs = {}
+    for dataset, csv_path in data_csv.items():
+        real = pd.read_csv(os.path.join(MAIN_DIR, os.path.basename(csv_path)))  # Real CSVs, regardless of MEL_CNN_DATA_DIR
+        df = real.sample(n=counts.get(dataset, synthetic_args['test_count']), replace=True,
+                         random_state=rng.integers(2 ** 31)).reset_index(drop=True)
+        df['image'] = [os.path.join(dataset_id, 'data', f"synthetic_{dataset}_{i:06d}.jpg")
+                       for i, dataset_id in enumerate(df['dataset_id'])]
+        dfs[dataset] = df
+    return dfs
+
+
+if __name__ == '__main__':
+    synthetic_args = vars(synthetic_parser().parse_args())
+    os.makedirs(synthetic_args['output_dir'], exist_ok=True)
+    size = synthetic_args['image_size']
+    images = []
+    for dataset, df in synthetic_csvs(synthetic_args).items():
+        df.to_csv(os.path.join(synthetic_args['output_dir'], os.path.basename(data_csv[dataset])), index=False)
+        images += list(df['image'])
+        print("{}| Count:{}".format(os.path.basename(data_csv[dataset]).rjust(25), str(len(df)).rjust(6)))
+    images = sorted(set(images))
+
+    jobs = [(os.path.join(synthetic_args['output_dir'], f"proc_{size}", image), size, size) for image in images]
+    if synthetic_args['originals']:
+        width, height = synthetic_args['original_size']
+        jobs += [(os.path.join(synthetic_args['output_dir'], 'data', image), height, width) for image in images]
+    Parallel(n_jobs=synthetic_args['jobs'])(delayed(write_image)(path, height, width, synthetic_args['seed'] + i)
+                                            for i, (path, height, width) in enumerate(jobs))
+    print(f"{len(jobs)} images written to {synthetic_args['output_dir']}")
@@ -5,8 +5,20 @@ import os
 def set_tf_config(resolver, environment=None):
     """Set the TF_CONFIG env variable from the given cluster resolver"""
     cfg = {'cluster': resolver.cluster_spec().as_dict(),
-           'task': {'type': resolver.get_task_info()[0], 'index': resolver.get_task_info()[1]},
+           'task': {'type': resolver.task_type, 'index': resolver.task_id},
            'rpc_layer': resolver.rpc_layer}
     if environment:
         cfg['environment'] = environment
     os.environ['TF_CONFIG'] = json.dumps(cfg)
+
+
+def cluster_resolver(args):
+    """Cluster of --strategy multiworker: the SLURM job's tasks, or --num-workers processes on localhost."""
+    import tensorflow as tf
+    if args['cluster'] == 'slurm':
+        return tf.distribute.cluster_resolver.SlurmClusterResolver(port_base=args['base_port'], gpus_per_node=args['gpus'],
+                                                                   gpus_per_task=args['gpus'], auto_set_gpu=False)
+    cluster_spec = tf.train.ClusterSpec({'worker': [f"localhost:{args['base_port'] + index}"
+                                                    for index in range(args['num_workers'])]})
+    return tf.distribute.cluster_resolver.SimpleClusterResolver(cluster_spec, task_type='worker',
+                                                                task_id=args['worker_index'], rpc_layer='grpc')